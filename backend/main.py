@@ -1,14 +1,42 @@
+import time
+_IMPORT_STARTED = time.monotonic()
+
+import logging
 from fastapi import FastAPI
-from routes import chat, batch
+from routes import chat, batch, stats, metrics
 from utils.authorization import auth_middleware
-from utils.vllm_queue import start_vllm_consumer, interactive_queue, batch_queue
+from utils.http_client import start_http_client, close_http_client
+from utils.vllm_queue import start_vllm_consumer, start_concurrent_dispatcher, interactive_queue, batch_queue, ConcurrencyLimit
+from utils.concurrency import start_adaptive_concurrency
+from utils.backends import backend_pool
+from utils.tracing import start_tracing
+from utils.truncation import start_tokenizer_loading, startup_seconds
+from utils.store import store
+from utils.batch_parsing import shutdown_parse_pool
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
+
 
+# "concurrent": start every interactive request immediately, bounded by INTERACTIVE_MAX_CONCURRENCY.
+# "batched": INTERACTIVE_WORKERS micro-batching consumers, as used for the batch queue.
+INTERACTIVE_DISPATCH_MODE = "concurrent"
+INTERACTIVE_MAX_CONCURRENCY = 128
 
 INTERACTIVE_WORKERS = 4
 INTERACTIVE_BATCH_SIZE = 1
-INTERACTIVE_WAIT_TIME = 0.01
+INTERACTIVE_WAIT_TIME = 0.0
+
+# "continuous": keep BATCH_MAX_INFLIGHT requests in flight, refilling a slot as soon as one frees up.
+# "batched": BATCH_WORKERS consumers that gather BATCH_BATCH_SIZE requests in lock-step.
+BATCH_DISPATCH_MODE = "continuous"
+BATCH_MAX_INFLIGHT = 256
+BATCH_OCCUPANCY_WINDOW = 10.0
+# With BATCH_ADAPTIVE_CONCURRENCY the in-flight limit starts at BATCH_INITIAL_INFLIGHT and is tuned
+# at runtime between BATCH_MIN_INFLIGHT and BATCH_MAX_INFLIGHT (continuous mode only).
+BATCH_ADAPTIVE_CONCURRENCY = True
+BATCH_INITIAL_INFLIGHT = 32
+BATCH_MIN_INFLIGHT = 8
 
 BATCH_WORKERS = 2
 BATCH_BATCH_SIZE = 128
@@ -16,24 +44,68 @@ BATCH_WAIT_TIME = 0.1
 
 @app.on_event("startup")
 async def startup_event():
+    start_tracing()
+
+    # Load the tokenizer in the background; requests that need no truncation never wait on it
+    start_tokenizer_loading(started_at=_IMPORT_STARTED)
+
+    # Open the shared upstream connection pool before any consumer needs it
+    await start_http_client()
+    backend_pool.start_health_checks()
+
     # Start consumers for the interactive queue
-    for i in range(INTERACTIVE_WORKERS):
-        start_vllm_consumer(
-            worker_id=i, 
-            queue=interactive_queue, 
-            batch_size=INTERACTIVE_BATCH_SIZE, 
-            wait_time=INTERACTIVE_WAIT_TIME
+    if INTERACTIVE_DISPATCH_MODE == "concurrent":
+        start_concurrent_dispatcher(
+            worker_id=0,
+            queue=interactive_queue,
+            max_concurrency=INTERACTIVE_MAX_CONCURRENCY
         )
+    else:
+        for i in range(INTERACTIVE_WORKERS):
+            start_vllm_consumer(
+                worker_id=i, 
+                queue=interactive_queue, 
+                batch_size=INTERACTIVE_BATCH_SIZE, 
+                wait_time=INTERACTIVE_WAIT_TIME
+            )
     
     # Start consumers for the batch queue
-    for i in range(BATCH_WORKERS):
-        start_vllm_consumer(
-            worker_id=i + INTERACTIVE_WORKERS, 
-            queue=batch_queue, 
-            batch_size=BATCH_BATCH_SIZE, 
-            wait_time=BATCH_WAIT_TIME
+    if BATCH_DISPATCH_MODE == "continuous":
+        batch_limit = None
+        if BATCH_ADAPTIVE_CONCURRENCY:
+            batch_limit = ConcurrencyLimit(BATCH_INITIAL_INFLIGHT)
+            start_adaptive_concurrency("batch", batch_limit, BATCH_MIN_INFLIGHT, BATCH_MAX_INFLIGHT)
+        start_concurrent_dispatcher(
+            worker_id=INTERACTIVE_WORKERS,
+            queue=batch_queue,
+            max_concurrency=BATCH_MAX_INFLIGHT,
+            occupancy_window=BATCH_OCCUPANCY_WINDOW,
+            limit=batch_limit
         )
+    else:
+        for i in range(BATCH_WORKERS):
+            start_vllm_consumer(
+                worker_id=i + INTERACTIVE_WORKERS, 
+                queue=batch_queue, 
+                batch_size=BATCH_BATCH_SIZE, 
+                wait_time=BATCH_WAIT_TIME
+            )
+
+    # Pick up batches that were still running when the gateway last stopped
+    await batch.resume_unfinished_batches()
+
+    ready_after = time.monotonic() - _IMPORT_STARTED
+    startup_seconds.set(ready_after, labels=("app",))
+    logger.info(f"Gateway ready {ready_after:.2f}s after import started.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_http_client()
+    shutdown_parse_pool()
+    store.close()
 
 app.middleware("http")(auth_middleware)
 app.include_router(chat.router)
 app.include_router(batch.router)
+app.include_router(stats.router)
+app.include_router(metrics.router)
@@ -1,19 +1,37 @@
 import asyncio
+import gzip
 import json
+import logging
+import shutil
 import uuid
 import os
+import time
+from contextlib import aclosing
 from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Tuple
 
-from fastapi import APIRouter, HTTPException, BackgroundTasks, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Request
+from fastapi.responses import JSONResponse, FileResponse
+from starlette.requests import ClientDisconnect
 
 from utils.schemas import Batch, FileObject, BatchCreate
-from utils.config import VLLM_URL
+from utils.config import RESPONSE_CACHE_ENABLED, PRECOMPRESS_OUTPUT_FILES
 from utils.vllm_queue import batch_queue, VLLMRequest
-from utils.truncation import truncate_messages, MAX_INPUT_LENGTH
+from utils.authorization import api_key_id
+from utils.tracing import stage_durations, record_trace
+from utils.truncation import truncate_messages_async, prompt_token_budget, token_count_cache, truncated_requests
+from utils.metrics import Counter, Gauge
+from utils.batch_writer import BatchResultWriter
+from utils.file_index import remove_indexed
+from utils.uploads import receive_upload, UploadError
+from utils.batch_parsing import parse_batch_file
+from utils.passthrough import RawJSON, body_usage, compact
+from utils.store import store
+from utils import response_cache
 
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 batches_db = {}
 files_db = {}
@@ -21,206 +39,607 @@ files_db = {}
 os.makedirs("batch_files", exist_ok=True)
 FILES_DIR = "batch_files"
 
-@router.post("/v1/files", response_model=FileObject)
-async def upload_file(file: UploadFile = File(...), purpose: str = Form(...)):
-    if purpose != "batch":
-        raise HTTPException(status_code=400, detail="Purpose must be 'batch'")
+# Uploads are copied to disk and indexed in pieces of this size, off the event loop
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Suffix of the precompressed copy of an output file
+GZIP_SUFFIX = ".gz"
+# Maximum number of requests per batch that are queued or in flight at any time
+BATCH_INGEST_WINDOW = 1024
+# Upper bound on how long completed results may sit in the writer before being fsynced
+BATCH_FSYNC_INTERVAL = 1.0
+# Lines read ahead and grouped by shared prompt prefix before dispatch
+BATCH_PREFIX_LOOKAHEAD = 4096
+# Requests of one prefix group are enqueued back to back in chunks of at most this size
+BATCH_PREFIX_CHUNK = 256
+# Queue a max_tokens=1 request carrying just the prefix ahead of each new prefix group. Off by
+# default: the group does not wait for it, so it only helps when vLLM runs it a step earlier
+BATCH_PREFIX_WARMUP = False
+BATCH_PREFIX_WARMUP_MIN_CHARS = 512
+# Characters per token assumed for the cached-prefix estimate until the prefix has been counted
+PREFIX_CHARS_PER_TOKEN = 4
+# Share of the batch queue a batch gets relative to the other batches of the same API key,
+# set with metadata {"weight": "..."}; API keys share the queue equally
+BATCH_WEIGHT_METADATA_KEY = "weight"
+BATCH_MIN_WEIGHT = 0.01
+BATCH_MAX_WEIGHT = 100.0
+# With metadata {"timings": "true"} every output line carries the request's stage durations
+BATCH_TIMINGS_METADATA_KEY = "timings"
+# Batches in these states are picked up again after a restart
+UNFINISHED_STATUSES = ("pending", "validating", "in_progress", "finalizing", "cancelling")
+
+_resumed_tasks = set()
+
+estimated_cached_prefix_tokens = Counter(
+    "gateway_estimated_cached_prefix_tokens_total",
+    "Prompt tokens expected to be served from vLLM's prefix cache thanks to prefix-grouped dispatch.",
+)
+batch_inflight = Gauge(
+    "gateway_batch_inflight_requests",
+    "Requests of each running batch that are queued or in flight.",
+    labelnames=("batch",),
+)
+context_retries = Counter(
+    "gateway_context_retries_total",
+    "Requests retried with a truncated prompt after vLLM rejected them as too long.",
+    labelnames=("route",),
+)
+
+# The body is parsed by hand in upload_file, so its form is described for the docs here
+_UPLOAD_FORM_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "purpose": {"type": "string", "enum": ["batch"]},
+                    },
+                    "required": ["file", "purpose"],
+                }
+            }
+        },
+    }
+}
 
+
+@router.post("/v1/files", response_model=FileObject, openapi_extra=_UPLOAD_FORM_SCHEMA)
+async def upload_file(request: Request):
     file_id = f"file-{uuid.uuid4()}"
     file_path = os.path.join(FILES_DIR, file_id)
 
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
-
-    file_size = os.path.getsize(file_path)
+    # Parse the multipart body as it arrives and write the file part straight into place,
+    # indexing lines, validating JSON and hashing in the same pass
+    try:
+        upload = await receive_upload(request.headers.get("content-type", ""), request.stream(), "file", file_path, UPLOAD_CHUNK_SIZE)
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ClientDisconnect:
+        logger.info(f"Upload of {file_id} abandoned by the client.")
+        raise HTTPException(status_code=400, detail="Client disconnected during upload")
+
+    # The purpose field may come after the file, so it can only be checked once the body is read
+    purpose = upload.fields.get("purpose")
+    if purpose != "batch":
+        await asyncio.to_thread(remove_indexed, file_path)
+        raise HTTPException(status_code=400, detail="Purpose must be 'batch'")
 
     file_object = FileObject(
         id=file_id,
-        bytes=file_size,
+        bytes=upload.stats.bytes,
         created_at=int(datetime.now().timestamp()),
-        filename=file.filename,
+        filename=upload.filename,
         purpose=purpose,
+        line_count=upload.stats.line_count,
+        invalid_lines=upload.stats.invalid_lines,
+        checksum=upload.stats.checksum,
     )
     files_db[file_id] = file_object
+    store.save_file(file_object)
     return file_object
 
-async def process_batch_in_background(batch_id: str):
+def _accepts_gzip(accept_encoding: str) -> bool:
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            q = params.strip()
+            if not q.startswith("q="):
+                return True
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
+@router.get("/v1/files/{file_id}/content")
+async def download_file_content(file_id: str, request: Request):
+    """
+    Sends a file's bytes without reading them into the gateway. Range requests are honoured so
+    interrupted downloads can resume, and clients accepting gzip get the precompressed copy
+    when one exists. Zero-copy transfer is used where the ASGI server offers it.
+    """
+    file_object = files_db.get(file_id)
+    file_path = os.path.join(FILES_DIR, file_id)
+    if file_object is None or not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    headers = {"Vary": "Accept-Encoding"}
+    gzip_path = file_path + GZIP_SUFFIX
+    if _accepts_gzip(request.headers.get("accept-encoding", "")) and os.path.isfile(gzip_path):
+        headers["Content-Encoding"] = "gzip"
+        file_path = gzip_path
+    return FileResponse(file_path, media_type="application/octet-stream", filename=file_object.filename, headers=headers)
+
+
+def _precompress(path: str):
+    """Writes `path`.gz next to the file, atomically so a partial copy is never served."""
+    tmp_path = path + GZIP_SUFFIX + ".tmp"
+    with open(path, "rb") as f_in, gzip.open(tmp_path, "wb", compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out, UPLOAD_CHUNK_SIZE)
+    os.replace(tmp_path, path + GZIP_SUFFIX)
+
+
+def _build_request(content: str, custom_id: str, endpoint: str) -> VLLMRequest:
+    """Wraps a rendered system prompt into a vLLM request."""
+    return VLLMRequest(
+        custom_id=custom_id,
+        request_body={
+            "model": "qwen3-4b",
+            "messages": [{"role": "system", "content": content}],
+            "max_tokens": 256,
+            "priority": 10
+        },
+        vllm_endpoint=endpoint
+    )
+
+
+def _prefix_token_estimate(prefix: str, key: bytes) -> int:
+    """
+    Tokens in a template prefix, for the cached-prefix estimate only. Uses the count truncation
+    cached for the prefix when there is one; never waits on the tokenizer.
+    """
+    count = token_count_cache.get(key)
+    return count if count is not None else len(prefix) // PREFIX_CHARS_PER_TOKEN
+
+
+def _batch_weight(metadata) -> float:
+    """Reads a batch's scheduling weight from its metadata. Raises ValueError if it is invalid."""
+    raw = (metadata or {}).get(BATCH_WEIGHT_METADATA_KEY)
+    if raw is None:
+        return 1.0
+    weight = float(raw)
+    if not BATCH_MIN_WEIGHT <= weight <= BATCH_MAX_WEIGHT:
+        raise ValueError(f"weight must be between {BATCH_MIN_WEIGHT} and {BATCH_MAX_WEIGHT}")
+    return weight
+
+
+def _warm_prefix(prefix: str, model: str, endpoint: str, warmup_id: str, like: VLLMRequest):
+    """
+    Queues the bare prefix with max_tokens=1 in front of its group so vLLM starts prefilling it
+    first. Nothing waits for it: the group is dispatched straight after, and its result is dropped.
+    """
+    warmup_request = VLLMRequest(
+        custom_id=warmup_id,
+        request_body={
+            "model": model,
+            "messages": [{"role": "system", "content": prefix}],
+            "max_tokens": 1,
+            "priority": 10
+        },
+        vllm_endpoint=endpoint,
+        flow=like.flow,
+        weight=like.weight,
+        routing_key=like.routing_key
+    )
+    batch_queue.put_nowait(warmup_request)
+
+
+async def _preflight_truncate(req: VLLMRequest, prefix: str, prefix_key: bytes):
+    """
+    Pre-flight length gate: truncate before enqueueing so the line needs a single round trip.
+    The line's template prefix is counted once per template via the token-count cache.
+    """
+    messages = req.request_body["messages"]
+    original_length = sum(len(msg["content"]) for msg in messages)
+    await truncate_messages_async(messages, prompt_token_budget(req.request_body.get("max_tokens")), prefix, prefix_key)
+    if sum(len(msg["content"]) for msg in messages) != original_length:
+        truncated_requests.inc(labels=("batch",))
+
+
+def _is_context_too_long_error(body) -> bool:
+    try:
+        if not isinstance(body, dict):
+            return False
+        message = (
+            str(body.get("message", ""))
+            or str(body.get("detail", ""))
+            or str(body.get("error", ""))
+        ).lower()
+        return "too long" in message or "context length" in message or "max context" in message
+    except Exception:
+        return False
+
+
+def _record_response(writer: BatchResultWriter, custom_id: str, status_code, body, timings: Optional[Dict[str, float]] = None):
+    """Queues a vLLM response for the output file (200) or the error file (anything else)."""
+    if isinstance(body, RawJSON) and status_code == 200:
+        # Splice the upstream bytes into the line instead of decoding and re-encoding them
+        entry = b"".join((
+            b'{"custom_id": ', json.dumps(custom_id).encode("utf-8"),
+            b', "response": {"status_code": 200, "body": ', compact(body.data), b"}",
+            b', "timings": ' + json.dumps(timings).encode("utf-8") if timings is not None else b"",
+            b"}\n",
+        ))
+    else:
+        entry = {
+            "custom_id": custom_id,
+            "response": {"status_code": status_code, "body": body}
+        }
+        if timings is not None:
+            entry["timings"] = timings
+    if status_code != 200:
+        writer.write_error(entry)
+        return
+
+    # Aggregate token usage if provided by vLLM
+    usage = body_usage(body) or {}
+    prompt_tokens = int(usage.get("prompt_tokens", 0))
+    completion_tokens = int(usage.get("completion_tokens", 0))
+    writer.write_output(entry, prompt_tokens, completion_tokens)
+
+
+async def _handle_result(req: VLLMRequest, writer: BatchResultWriter, include_timings: bool = False):
+    """Waits for a request's result and hands it to the batch's writer."""
+    try:
+        result = await req.future
+    except asyncio.CancelledError:
+        return
+    except Exception as e:
+        result = e
+
+    if isinstance(result, Exception):
+        writer.write_error({
+            "custom_id": req.custom_id,
+            "response": {"status_code": 500, "body": f"An unexpected error occurred: {str(result)}"}
+        })
+        return
+
+    status_code = result.get("status_code")
+    body = result.get("body")
+
+    # Retry once with truncated messages if the error indicates context is too long.
+    # Every request has its own result task, so these retries run concurrently.
+    if status_code == 400 and _is_context_too_long_error(body):
+        context_retries.inc(labels=("batch",))
+        try:
+            original_payload = dict(req.request_body)
+            original_messages = [dict(msg) for msg in original_payload.get("messages", [])]
+            truncated_messages = await truncate_messages_async(original_messages, prompt_token_budget(original_payload.get("max_tokens")))
+            retry_payload = {**original_payload, "messages": truncated_messages}
+            retry_request = VLLMRequest(
+                custom_id=f"{req.custom_id}-retry",
+                request_body=retry_payload,
+                vllm_endpoint=req.vllm_endpoint,
+                flow=req.flow,
+                weight=req.weight,
+                routing_key=req.routing_key,
+            )
+            await batch_queue.put(retry_request)
+            retry_result = await asyncio.wait_for(retry_request.future, timeout=180)
+            status_code = retry_result.get("status_code")
+            body = retry_result.get("body")
+            # The upstream stage spans both attempts
+            req.mark("upstream_done")
+        except Exception as retry_exc:
+            # Retry failed due to internal error
+            status_code = 500
+            body = {"error": str(retry_exc)}
+
+    req.mark("responded")
+    record_trace(req, "batch")
+    _record_response(writer, req.custom_id, status_code, body, stage_durations(req) if include_timings else None)
+
+
+def _repair_tail(path: str):
+    """Drops a partially written last line left behind by a crash."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            step = min(65536, position)
+            f.seek(position - step)
+            chunk = f.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if position != end:
+            f.truncate(position)
+
+
+def _read_entries(path: str):
+    """
+    Yields the JSON objects recorded in a result file. Lines that cannot be read, e.g. damaged
+    by a crash or a bad disk, are skipped with a warning, so their requests are run again.
+    """
+    if not os.path.exists(path):
+        return
+    skipped = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if not isinstance(entry, dict):
+                skipped += 1
+                continue
+            yield entry
+    if skipped:
+        logger.warning(f"Skipped {skipped} unreadable lines in {path}.")
+
+
+def _recover_progress(output_file_path: str, error_file_path: str) -> Tuple[Set[str], Set[str], int, int, int, int]:
+    """
+    Reads what an earlier run already recorded for a batch. Returns the custom_ids that have a
+    response, the custom_ids of input lines that failed to parse, and the completed/failed
+    counts and token usage found in the files.
+    """
+    done_requests, done_lines = set(), set()
+    completed = failed = prompt_tokens = completion_tokens = 0
+
+    _repair_tail(output_file_path)
+    for entry in _read_entries(output_file_path):
+        custom_id = entry.get("custom_id")
+        if custom_id is None:
+            continue
+        done_requests.add(custom_id)
+        completed += 1
+        response = entry.get("response")
+        body = response.get("body") if isinstance(response, dict) else None
+        usage = (body.get("usage") if isinstance(body, dict) else None) or {}
+        if isinstance(usage, dict):
+            prompt_tokens += int(usage.get("prompt_tokens") or 0)
+            completion_tokens += int(usage.get("completion_tokens") or 0)
+
+    _repair_tail(error_file_path)
+    for entry in _read_entries(error_file_path):
+        failed += 1
+        custom_id = entry.get("custom_id")
+        if custom_id is None:
+            continue
+        (done_requests if "response" in entry else done_lines).add(custom_id)
+
+    return done_requests, done_lines, completed, failed, prompt_tokens, completion_tokens
+
+
+async def process_batch_in_background(batch_id: str, resume: bool = False):
     """
     The background task for processing a batch.
+
+    Input lines are read, rendered and enqueued lazily, with at most BATCH_INGEST_WINDOW
+    requests of this batch outstanding at once. Results are appended in completion order by a
+    BatchResultWriter, and request_counts/usage advance only once results are fsynced.
+
+    With `resume`, the batch continues appending to the files of an earlier run and skips
+    every custom_id those files already contain.
     """
     batch = batches_db.get(batch_id)
     if not batch:
         return
 
-    batch.status = "in_progress"
-    batch.in_progress_at = int(datetime.now().timestamp())
-    batch.expires_at = int((datetime.now() + timedelta(hours=24)).timestamp())
+    output_file_id, error_file_id = store.working_files(batch_id) if resume else (None, None)
+    if output_file_id is None:
+        resume = False
+        output_file_id = f"file-{uuid.uuid4()}"
+        error_file_id = f"file-{uuid.uuid4()}"
+    output_file_path = os.path.join(FILES_DIR, output_file_id)
+    error_file_path = os.path.join(FILES_DIR, error_file_id)
+    input_file_path = os.path.join(FILES_DIR, batch.input_file_id)
+
     if getattr(batch, "usage", None) is None:
         batch.usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    if RESPONSE_CACHE_ENABLED and batch.response_cache is None:
+        batch.response_cache = {}
 
-    input_file_path = os.path.join(FILES_DIR, batch.input_file_id)
-    output_file_id = f"file-{uuid.uuid4()}"
-    error_file_id = f"file-{uuid.uuid4()}"
-    output_file_path = os.path.join(FILES_DIR, output_file_id)
-    error_file_path = os.path.join(FILES_DIR, error_file_id)
+    include_timings = (batch.metadata or {}).get(BATCH_TIMINGS_METADATA_KEY, "").lower() in ("1", "true", "yes")
 
-    requests_to_process = []
+    # This batch's sub-queue in the fair scheduler
+    flow = (batch.api_key_id or "anonymous", batch_id)
     try:
-        with open(input_file_path, "r") as f_in:
-            for i, line in enumerate(f_in):
-                try:
-                    request_data = json.loads(line)
-                    messages = request_data.get("messages", [])
-                    system_message = next((msg for msg in messages if msg.get("role") == "system"), None)
-                    user_message = next((msg for msg in messages if msg.get("role") == "user"), None)
-
-                    if not system_message or not user_message:
-                        raise ValueError("Missing system or user message in the input data.")
-
-                    template = system_message.get("content", "")
-                    data = user_message.get("content", "")
-                    
-                    final_content = template.replace("<user_profile>", data).replace("<system_info>", "")
-                    final_message = {"role": "system", "content": final_content}
-                    
-                    custom_id = f"request-{i+1}"
-                    request_body = {
-                        "model": "qwen3-4b",
-                         "messages": [final_message],
-                         "max_tokens": 256
-                    }
-                    
-                    vllm_request = VLLMRequest(
-                        custom_id=custom_id,
-                        request_body={
-                            **request_body,
-                            "priority": 10
-                        },
-                        vllm_endpoint=batch.endpoint
-                    )
-                    requests_to_process.append(vllm_request)
-
-                except (json.JSONDecodeError, ValueError) as e:
-                    batch.request_counts.failed += 1
-                    with open(error_file_path, "a") as f_err:
-                        error_result = {"error": f"Error processing line {i+1}: {e}"}
-                        f_err.write(json.dumps(error_result) + "\n")
+        weight = _batch_weight(batch.metadata)
+    except ValueError:
+        weight = 1.0
+
+    done_requests, done_lines = set(), set()
+    if resume:
+        try:
+            done_requests, done_lines, completed, failed, prompt_tokens, completion_tokens = await asyncio.to_thread(
+                _recover_progress, output_file_path, error_file_path
+            )
+        except Exception as e:
+            logger.exception(f"Could not resume batch {batch_id}: {e}")
+            batch.status = "failed"
+            batch.failed_at = int(datetime.now().timestamp())
+            batch.errors = {"code": "500", "message": f"Failed to recover the results of an earlier run: {e}"}
+            store.save_batch(batch)
+            return
+        batch.request_counts.total = 0
+        batch.request_counts.completed = completed
+        batch.request_counts.failed = failed
+        batch.usage.update({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+        logger.info(f"Resuming batch {batch_id}: {completed} completed and {failed} failed results already recorded.")
+    else:
+        batch.in_progress_at = int(datetime.now().timestamp())
+        batch.expires_at = int((datetime.now() + timedelta(hours=24)).timestamp())
+
+    # Files indexed at upload report their size up front; otherwise the total grows as lines are read
+    input_file = files_db.get(batch.input_file_id)
+    known_total = input_file.line_count if input_file is not None else None
+    if known_total is not None:
+        batch.request_counts.total = known_total
+
+    if batch.status != "cancelling":
+        batch.status = "in_progress"
+    store.save_batch(batch, output_file_id, error_file_id)
+
+    def on_durable(completed: int, failed: int, prompt_tokens: int, completion_tokens: int):
+        batch.request_counts.completed += completed
+        batch.request_counts.failed += failed
+        batch.usage["prompt_tokens"] = batch.usage.get("prompt_tokens", 0) + prompt_tokens
+        batch.usage["completion_tokens"] = batch.usage.get("completion_tokens", 0) + completion_tokens
+        store.save_batch(batch)
+
+    writer = BatchResultWriter(output_file_path, error_file_path, on_durable, fsync_interval=BATCH_FSYNC_INTERVAL)
+    writer.start()
+
+    pending = {}  # custom_id -> (VLLMRequest, task awaiting its result)
+    window = asyncio.Semaphore(BATCH_INGEST_WINDOW)
+    groups = {}  # prefix hash -> (prefix, requests read ahead but not dispatched yet)
+    dispatched_prefixes = set()  # prefix hashes already dispatched in this batch
+
+    def halted() -> bool:
+        # Cancelled, or results can no longer be recorded, so sending more requests is wasted work
+        return batch.status == "cancelling" or writer.failed.is_set()
+
+    async def track(req: VLLMRequest):
+        try:
+            await _handle_result(req, writer, include_timings)
+        finally:
+            pending.pop(req.custom_id, None)
+            batch_inflight.set(len(pending), (batch_id,))
+            window.release()
+
+    async def dispatch_group(key: bytes, prefix: str, group: list):
+        """Enqueues one prefix group back to back so its requests hit vLLM's prefix cache together."""
+        first_dispatch = key not in dispatched_prefixes
+        if first_dispatch:
+            dispatched_prefixes.add(key)
+            if BATCH_PREFIX_WARMUP and len(group) > 1 and len(prefix) >= BATCH_PREFIX_WARMUP_MIN_CHARS:
+                _warm_prefix(prefix, group[0].request_body["model"], batch.endpoint, f"{batch_id}-warmup-{len(dispatched_prefixes)}", group[0])
+
+        for start in range(0, len(group), BATCH_PREFIX_CHUNK):
+            chunk = group[start:start + BATCH_PREFIX_CHUNK]
+            # Backpressure: wait for free slots in this batch's window before dispatching
+            for _ in chunk:
+                await window.acquire()
+            if halted():
+                for _ in chunk:
+                    window.release()
+                return
+
+            # Pre-flight truncation of the whole chunk shares batched tokenizer calls
+            await asyncio.gather(*(_preflight_truncate(req, prefix, key) for req in chunk))
+            enqueued_at = time.monotonic()
+            for req in chunk:
+                req.enqueued_at = enqueued_at
+            uncached = [req for req in chunk if not await response_cache.resolve(req, batch_queue, "batch", batch.response_cache)]
+            for req in uncached:
+                batch_queue.put_nowait(req)
+            for req in chunk:
+                pending[req.custom_id] = (req, asyncio.create_task(track(req)))
+            batch_inflight.set(len(pending), (batch_id,))
+            if known_total is None:
+                batch.request_counts.total += len(chunk)
+
+            # Every request after the first one to carry the prefix should find it cached. A warm-up
+            # is not waited for, so the first carrier still counts as uncached
+            cached = len(chunk) - (1 if first_dispatch else 0)
+            first_dispatch = False
+            if cached > 0 and prefix:
+                estimate = cached * _prefix_token_estimate(prefix, key)
+                estimated_cached_prefix_tokens.inc(estimate)
+                batch.estimated_cached_prefix_tokens = (batch.estimated_cached_prefix_tokens or 0) + estimate
+
+    async def flush_groups():
+        # Groups go out in order of first appearance
+        for key, (prefix, group) in list(groups.items()):
+            del groups[key]
+            if halted():
+                return
+            await dispatch_group(key, prefix, group)
+
+    try:
+        # Lines are parsed and rendered in shards by the parsing pool and arrive here in order
+        line_number = buffered = 0
+        async with aclosing(parse_batch_file(input_file_path)) as shards:
+            async for prefixes, parsed_lines in shards:
+                for parsed in parsed_lines:
+                    if halted():
+                        break
+                    line_number += 1
+
+                    custom_id = f"request-{line_number}"
+                    # Already recorded by an earlier run of this batch
+                    if custom_id in done_requests:
+                        if known_total is None:
+                            batch.request_counts.total += 1
+                        continue
+                    if custom_id in done_lines:
+                        continue
+
+                    if isinstance(parsed, str):
+                        writer.write_error({"custom_id": custom_id, "error": f"Error processing line {line_number}: {parsed}"})
+                        continue
+                    content, key = parsed
+                    prefix = prefixes[key]
+                    vllm_request = _build_request(content, custom_id, batch.endpoint)
+                    vllm_request.flow = flow
+                    vllm_request.weight = weight
+
+                    if prefix:
+                        # Keep a prefix group on one backend so it shares that server's prefix cache
+                        vllm_request.routing_key = key.hex()
+                    groups.setdefault(key, (prefix, []))[1].append(vllm_request)
+                    buffered += 1
+                    if buffered >= BATCH_PREFIX_LOOKAHEAD:
+                        await flush_groups()
+                        buffered = 0
+                if halted():
+                    break
+
+        await flush_groups()
+
+        writer_failed = asyncio.ensure_future(writer.failed.wait())
+        try:
+            while pending and not halted():
+                await asyncio.wait([writer_failed, *(task for _, task in pending.values())], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            writer_failed.cancel()
 
     except Exception as e:
         batch.status = "failed"
         batch.failed_at = int(datetime.now().timestamp())
         batch.errors = {"code": "500", "message": f"Failed to read or parse input file: {e}"}
-        return
-
-
-    batch.request_counts.total = len(requests_to_process)
-
-    for req in requests_to_process:
-        await batch_queue.put(req)
-
-    tasks = [req.future for req in requests_to_process]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-    def _is_context_too_long_error(body) -> bool:
+    finally:
+        # Queued requests of an aborted or cancelled batch are skipped by the dispatcher
+        for req, task in list(pending.values()):
+            req.future.cancel()
+            task.cancel()
         try:
-            if not isinstance(body, dict):
-                return False
-            message = (
-                str(body.get("message", ""))
-                or str(body.get("detail", ""))
-                or str(body.get("error", ""))
-            ).lower()
-            return "too long" in message or "context length" in message or "max context" in message
+            await writer.close()
         except Exception:
-            return False
+            # Already logged by the writer; the batch is failed below from writer.error
+            pass
+        batch_queue.drop_flow(*flow)
+        batch_inflight.remove((batch_id,))
 
-    with open(output_file_path, "w") as f_out, open(error_file_path, "a") as f_err:
-        for i, result in enumerate(results):
-            req = requests_to_process[i]
+    if writer.error is not None and batch.status != "failed":
+        batch.status = "failed"
+        batch.failed_at = int(datetime.now().timestamp())
+        batch.errors = {"code": "500", "message": f"Failed to write batch results: {writer.error}"}
 
-            if batch.status == "cancelling":
-                break
-            
-            if isinstance(result, Exception):
-                batch.request_counts.failed += 1
-                error_entry = {
-                    "custom_id": req.custom_id,
-                    "response": {"status_code": 500, "body": f"An unexpected error occurred: {str(result)}"}
-                }
-                f_err.write(json.dumps(error_entry) + "\n")
-            else:
-                status_code = result.get("status_code")
-                body = result.get("body")
-
-                if status_code == 200:
-                    response_entry = {
-                        "custom_id": req.custom_id,
-                        "response": {"status_code": status_code, "body": body}
-                    }
-                    f_out.write(json.dumps(response_entry) + "\n")
-                    batch.request_counts.completed += 1
-
-                    # Aggregate token usage if provided by vLLM
-                    if isinstance(body, dict):
-                        usage = body.get("usage") or {}
-                        if isinstance(usage, dict):
-                            batch.usage["prompt_tokens"] = batch.usage.get("prompt_tokens", 0) + int(usage.get("prompt_tokens", 0))
-                            batch.usage["completion_tokens"] = batch.usage.get("completion_tokens", 0) + int(usage.get("completion_tokens", 0))
-                else:
-                    # Retry once with truncated messages if the error indicates context is too long
-                    did_retry = False
-                    if status_code == 400 and _is_context_too_long_error(body):
-                        try:
-                            original_payload = dict(req.request_body)
-                            original_messages = list(original_payload.get("messages", []))
-                            truncated_messages = truncate_messages(original_messages, MAX_INPUT_LENGTH)
-                            retry_payload = {**original_payload, "messages": truncated_messages}
-                            retry_request = VLLMRequest(
-                                custom_id=f"{req.custom_id}-retry",
-                                request_body=retry_payload,
-                                vllm_endpoint=req.vllm_endpoint,
-                            )
-                            await batch_queue.put(retry_request)
-                            retry_result = await asyncio.wait_for(retry_request.future, timeout=180)
-                            did_retry = True
-
-                            retry_status = retry_result.get("status_code")
-                            retry_body = retry_result.get("body")
-
-                            if retry_status == 200:
-                                response_entry = {
-                                    "custom_id": req.custom_id,
-                                    "response": {"status_code": retry_status, "body": retry_body}
-                                }
-                                f_out.write(json.dumps(response_entry) + "\n")
-                                batch.request_counts.completed += 1
-                                continue
-                            else:
-                                error_entry = {
-                                    "custom_id": req.custom_id,
-                                    "response": {"status_code": retry_status, "body": retry_body}
-                                }
-                                f_err.write(json.dumps(error_entry) + "\n")
-                                batch.request_counts.failed += 1
-                                continue
-                        except Exception as retry_exc:
-                            # Retry failed due to internal error
-                            error_entry = {
-                                "custom_id": req.custom_id,
-                                "response": {"status_code": 500, "body": {"error": str(retry_exc)}}
-                            }
-                            f_err.write(json.dumps(error_entry) + "\n")
-                            batch.request_counts.failed += 1
-                            continue
-
-                    # No retry or retry not applicable: record original error
-                    error_entry = {
-                        "custom_id": req.custom_id,
-                        "response": {"status_code": status_code, "body": body}
-                    }
-                    f_err.write(json.dumps(error_entry) + "\n")
-                    batch.request_counts.failed += 1
+    if batch.status == "failed":
+        store.save_batch(batch)
+        return
 
+    batch.finalizing_at = int(datetime.now().timestamp())
     if batch.status == "cancelling":
         batch.status = "cancelled"
         batch.cancelled_at = int(datetime.now().timestamp())
@@ -238,6 +657,7 @@ async def process_batch_in_background(batch_id: str):
             filename=f"{batch_id}_output.jsonl",
             purpose="batch_output"
         )
+        store.save_file(files_db[output_file_id])
     else:
         batch.output_file_id = None
         if os.path.exists(output_file_path):
@@ -252,14 +672,42 @@ async def process_batch_in_background(batch_id: str):
             filename=f"{batch_id}_errors.jsonl",
             purpose="batch_output"
         )
+        store.save_file(files_db[error_file_id])
     else:
         batch.error_file_id = None
         if os.path.exists(error_file_path):
             os.remove(error_file_path)
 
+    store.save_batch(batch)
+
+    if PRECOMPRESS_OUTPUT_FILES:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is not None:
+                try:
+                    await asyncio.to_thread(_precompress, os.path.join(FILES_DIR, file_id))
+                except OSError as e:
+                    logger.warning(f"Could not precompress {file_id}: {e}")
+
+
+async def resume_unfinished_batches():
+    """Reloads persisted metadata and restarts every batch an earlier run left unfinished."""
+    files_db.update(store.load_files())
+    batches_db.update(store.load_batches())
+
+    for batch in batches_db.values():
+        if batch.status in UNFINISHED_STATUSES:
+            task = asyncio.create_task(process_batch_in_background(batch.id, resume=True))
+            _resumed_tasks.add(task)
+            task.add_done_callback(_resumed_tasks.discard)
+
 
 @router.post("/v1/batches", response_model=Batch, status_code=201)
-async def create_batch(batch_create: BatchCreate, background_tasks: BackgroundTasks):
+async def create_batch(batch_create: BatchCreate, background_tasks: BackgroundTasks, request: Request):
+    try:
+        _batch_weight(batch_create.metadata)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid metadata.{BATCH_WEIGHT_METADATA_KEY}: {e}")
+
     batch_id = f"batch_{uuid.uuid4()}"
     
     new_batch = Batch(
@@ -268,10 +716,13 @@ async def create_batch(batch_create: BatchCreate, background_tasks: BackgroundTa
         endpoint=batch_create.endpoint,
         completion_window=batch_create.completion_window,
         status="pending",
-        created_at=int(datetime.now().timestamp())
+        created_at=int(datetime.now().timestamp()),
+        api_key_id=api_key_id(request),
+        metadata=batch_create.metadata
     )
     
     batches_db[batch_id] = new_batch
+    store.save_batch(new_batch)
     background_tasks.add_task(process_batch_in_background, batch_id)
     
     return new_batch
@@ -294,5 +745,6 @@ async def cancel_batch(batch_id: str):
 
     batch.status = "cancelling"
     batch.cancelling_at = int(datetime.now().timestamp())
+    store.save_batch(batch)
     
     return batch
@@ -1,80 +1,179 @@
 import aiohttp
 import asyncio
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+import logging
+import time
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 from utils.schemas import ChatCompletionRequest
-from utils.truncation import truncate_messages, MAX_INPUT_LENGTH
-from utils.config import VLLM_URL
+from utils.truncation import truncate_messages_async, MAX_INPUT_LENGTH, truncated_requests
+from utils.config import (
+    INTERACTIVE_QUEUE_TIMEOUT,
+    INTERACTIVE_GENERATION_TIMEOUT,
+    INTERACTIVE_MAX_QUEUED,
+    STREAM_ADMISSION_TIMEOUT,
+)
 from utils.vllm_queue import interactive_queue, VLLMRequest
+from utils.metrics import Counter, Histogram
+from utils.tracing import server_timing, record_trace
+from utils.passthrough import RawJSON
+from utils import response_cache
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+shed_requests = Counter(
+    "gateway_shed_requests_total",
+    "Chat requests rejected with 429 by admission control.",
+    labelnames=("route", "reason"),
+)
+stream_ttft_seconds = Histogram(
+    "gateway_stream_ttft_seconds",
+    "Time from a streaming request entering the gateway queue to its first relayed chunk.",
+    labelnames=("route",),
+)
+
+
+def _shed(route: str, reason: str, detail: str):
+    shed_requests.inc(labels=(route, reason))
+    raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": "1"})
 
-async def send_request_with_retry(session, request: ChatCompletionRequest):
-    """Sends a request to vLLM, truncating and retrying if the context is too long."""
-    vllm_endpoint = f"{VLLM_URL}/v1/chat/completions"
-    payload = request.model_dump(exclude_none=True)
 
+class _SlotStreamingResponse(StreamingResponse):
+    """Releases the stream's dispatch slot however the response ends, even if it never starts."""
+
+    def __init__(self, content, slot: VLLMRequest, **kwargs):
+        super().__init__(content, **kwargs)
+        self._slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._slot.stream_done.set()
+            self._slot.mark("stream_end")
+            record_trace(self._slot, "chat_stream")
+
+
+async def _relay_stream(vllm_request: VLLMRequest, response: aiohttp.ClientResponse):
+    """Yields the upstream SSE bytes as they arrive. Errors after the first byte end the stream."""
+    first = True
     try:
-        resp = await session.post(vllm_endpoint, json=payload, timeout=180)
-        if resp.status == 200:
-            return resp
+        async for chunk in response.content.iter_any():
+            if first:
+                stream_ttft_seconds.observe(time.monotonic() - vllm_request.enqueued_at, ("chat",))
+                first = False
+            yield chunk
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Upstream stream ended early: {e!r}")
+    finally:
+        vllm_request.stream_done.set()
 
-        if resp.status == 400:
-            error_details = await resp.json()
-            if "too long" in error_details.get("message", ""):
-                request.messages = truncate_messages(request.messages, MAX_INPUT_LENGTH)
-                payload = request.model_dump(exclude_none=True)
-                return await session.post(vllm_endpoint, json=payload, timeout=180)
 
-        return resp
+async def _client_disconnect(http_request: Request):
+    """Returns once the client has gone away. The request body must already have been read."""
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
 
-    except (aiohttp.ClientConnectorError, asyncio.TimeoutError):
-        raise
 
+async def _wait_unless_disconnected(vllm_request: VLLMRequest, disconnected: asyncio.Future, timeout: float) -> bool:
+    """
+    Waits up to `timeout` for a request's future and returns whether it is done. If the client
+    disconnects first, the request is cancelled and its slot released straight away.
+    """
+    await asyncio.wait({vllm_request.future, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    if vllm_request.future.done():
+        return True
+    if disconnected.done():
+        vllm_request.future.cancel()
+        vllm_request.stream_done.set()
+        raise HTTPException(status_code=499, detail="Client disconnected.")
+    return False
 
-async def stream_vllm_response(request: ChatCompletionRequest):
-    """Proxy streaming requests to vLLM."""
-    request.messages = truncate_messages(request.messages, MAX_INPUT_LENGTH)
-    
-    async with aiohttp.ClientSession() as session:
-        vllm_endpoint = f"{VLLM_URL}/v1/chat/completions"
-        payload = request.model_dump(exclude_none=True)
-        payload["priority"] = 0
 
-        try:
-            async with session.post(vllm_endpoint, json=payload, timeout=180) as resp:
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    raise HTTPException(status_code=resp.status, detail=f"vLLM Error: {error_text}")
-                
-                async for chunk in resp.content.iter_any():
-                    yield chunk
-
-        except aiohttp.ClientConnectorError:
-            raise HTTPException(status_code=503, detail="Could not connect to vLLM service.")
-        except asyncio.TimeoutError:
+async def stream_vllm_response(request: ChatCompletionRequest, http_request: Request, received_at: float, truncated_at: float):
+    """
+    Streams a chat completion through the interactive queue. The stream holds a dispatch slot
+    until it ends or the client disconnects; if no slot frees up within
+    STREAM_ADMISSION_TIMEOUT the request is shed with a 429. Messages are already truncated.
+    """
+    payload = request.model_dump(exclude_none=True)
+    payload["priority"] = 0
+    vllm_request = VLLMRequest(request_body=payload, stream_done=asyncio.Event())
+    vllm_request.mark("received", received_at)
+    vllm_request.mark("truncated", truncated_at)
+    await interactive_queue.put(vllm_request)
+
+    # Watch for the client leaving only until the stream starts; the response takes over then
+    disconnected = asyncio.ensure_future(_client_disconnect(http_request))
+    try:
+        done = await _wait_unless_disconnected(vllm_request, disconnected, STREAM_ADMISSION_TIMEOUT)
+        if not done and vllm_request.dispatched_at is None:
+            vllm_request.future.cancel()
+            _shed("chat_stream", "admission_timeout", "No streaming capacity available; retry shortly.")
+
+        if not await _wait_unless_disconnected(vllm_request, disconnected, INTERACTIVE_GENERATION_TIMEOUT):
+            vllm_request.future.cancel()
+            vllm_request.stream_done.set()
             raise HTTPException(status_code=504, detail="Request to vLLM timed out.")
+    finally:
+        disconnected.cancel()
+    result = vllm_request.future.result()
+
+    if result["status_code"] != 200:
+        vllm_request.stream_done.set()
+        raise HTTPException(status_code=result["status_code"], detail=f"vLLM Error: {result['body']}")
+
+    return _SlotStreamingResponse(
+        _relay_stream(vllm_request, result["response"]),
+        slot=vllm_request,
+        media_type="text/event-stream",
+        headers={"Server-Timing": server_timing(vllm_request)},
+    )
 
 @router.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
-    request.messages = truncate_messages(request.messages, MAX_INPUT_LENGTH)
+async def chat_completions(request: ChatCompletionRequest, http_request: Request):
+    received_at = time.monotonic()
+    # Shed early rather than let queueing delay grow without bound
+    if interactive_queue.qsize() >= INTERACTIVE_MAX_QUEUED:
+        _shed("chat_stream" if request.stream else "chat", "queue_full", "Too many requests queued; retry shortly.")
+
+    original_length = sum(len(msg.content) for msg in request.messages)
+    request.messages = await truncate_messages_async(request.messages, MAX_INPUT_LENGTH)
+    if sum(len(msg.content) for msg in request.messages) != original_length:
+        truncated_requests.inc(labels=("chat_stream" if request.stream else "chat",))
+    truncated_at = time.monotonic()
     
     if request.stream:
-        return StreamingResponse(
-            stream_vllm_response(request),
-            media_type="text/event-stream"
-        )
+        return await stream_vllm_response(request, http_request, received_at, truncated_at)
     else:
         payload = request.model_dump(exclude_none=True)
         payload["priority"] = 0
         vllm_request = VLLMRequest(
             request_body=payload
         )
-        await interactive_queue.put(vllm_request)
-        
+        vllm_request.mark("received", received_at)
+        vllm_request.mark("truncated", truncated_at)
+        if not await response_cache.resolve(vllm_request, interactive_queue, "chat"):
+            await interactive_queue.put(vllm_request)
+
+        # Time spent queued and time spent generating are bounded separately
+        done, _ = await asyncio.wait({vllm_request.future}, timeout=INTERACTIVE_QUEUE_TIMEOUT)
+        if not done and vllm_request.dispatched_at is None:
+            vllm_request.future.cancel()
+            raise HTTPException(status_code=503, detail="Request timed out while waiting in the queue.")
+
         try:
-            result = await asyncio.wait_for(vllm_request.future, timeout=180)
-            return JSONResponse(content=result["body"], status_code=result["status_code"])
+            result = await asyncio.wait_for(vllm_request.future, timeout=INTERACTIVE_GENERATION_TIMEOUT)
+            body = result["body"]
+            if isinstance(body, RawJSON):
+                # Relay vLLM's bytes as they are rather than decoding and re-encoding them
+                response = Response(content=body.data, status_code=result["status_code"], media_type="application/json")
+            else:
+                response = JSONResponse(content=body, status_code=result["status_code"])
+            vllm_request.mark("responded")
+            response.headers["Server-Timing"] = server_timing(vllm_request)
+            record_trace(vllm_request, "chat")
+            return response
         except asyncio.TimeoutError:
-            raise HTTPException(status_code=504, detail="Request timed out while waiting in the queue.")
+            raise HTTPException(status_code=504, detail="Request to vLLM timed out.")
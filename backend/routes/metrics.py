@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from utils.authorization import METRICS_PATH
+from utils.metrics import render_prometheus
+
+router = APIRouter()
+
+
+@router.get(METRICS_PATH, response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Exposes every gateway metric in the Prometheus text format."""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+
+from utils.http_client import get_pool_stats
+from utils.metrics import snapshot
+from utils.vllm_queue import batch_queue
+from utils.backends import backend_pool
+from utils.truncation import tokenizer_status
+
+router = APIRouter()
+
+
+@router.get("/v1/stats")
+async def gateway_stats():
+    """Returns a JSON snapshot of the gateway's internal counters."""
+    return {
+        "upstream_pool": get_pool_stats(),
+        "backends": backend_pool.stats(),
+        "batch_scheduler": batch_queue.stats(),
+        "tokenizer": tokenizer_status(),
+        "metrics": snapshot(),
+    }
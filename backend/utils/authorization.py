@@ -1,11 +1,15 @@
+import hashlib
+
 from fastapi import Request
 from fastapi.responses import JSONResponse
 from starlette.status import HTTP_401_UNAUTHORIZED
 
-from utils.config import API_TOKEN
+from utils.config import API_TOKEN, METRICS_AUTH_EXEMPT
+
+METRICS_PATH = "/metrics"
 
 async def auth_middleware(request: Request, call_next):
-    if API_TOKEN:
+    if API_TOKEN and not (METRICS_AUTH_EXEMPT and request.url.path == METRICS_PATH):
         auth_header = request.headers.get("Authorization")
         if not auth_header or auth_header != f"Bearer {API_TOKEN}":
             return JSONResponse(
@@ -14,3 +18,12 @@ async def auth_middleware(request: Request, call_next):
             )
     response = await call_next(request)
     return response
+
+
+def api_key_id(request: Request) -> str:
+    """Returns a stable, non-secret identifier for the bearer token a request was made with."""
+    auth_header = request.headers.get("Authorization") or ""
+    token = auth_header[len("Bearer "):] if auth_header.startswith("Bearer ") else ""
+    if not token:
+        return "anonymous"
+    return "key-" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:12]
@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional
+
+from .config import VLLM_URLS, BACKEND_BALANCE, BACKEND_HEALTH_INTERVAL, BACKEND_HEALTH_TIMEOUT
+from .http_client import get_http_client
+from .metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# A request follows its prefix to the same backend unless that backend's load exceeds the
+# least-loaded one's by this factor plus STICKY_SLACK (bounded-load consistent hashing).
+STICKY_LOAD_FACTOR = 1.25
+STICKY_SLACK = 8
+# Characters of the first message that identify a prompt prefix when no routing key is given
+ROUTING_PREFIX_CHARS = 256
+# Consecutive failed health checks or connection errors before a backend is ejected
+UNHEALTHY_THRESHOLD = 2
+
+backend_outstanding = Gauge(
+    "gateway_backend_outstanding_requests",
+    "Requests currently in flight to each vLLM backend.",
+    labelnames=("backend",),
+)
+backend_healthy = Gauge(
+    "gateway_backend_healthy",
+    "1 while a vLLM backend receives traffic, 0 while it is ejected.",
+    labelnames=("backend",),
+)
+backend_requests = Counter(
+    "gateway_backend_requests_total",
+    "Requests sent to each vLLM backend, by outcome.",
+    labelnames=("backend", "result"),
+)
+
+
+def routing_key(request_body: Dict[str, Any]) -> Optional[str]:
+    """Derives a sticky-routing key from the start of the first message, if there is one."""
+    messages = request_body.get("messages") or []
+    if not messages or not isinstance(messages[0], dict):
+        return None
+    content = messages[0].get("content")
+    if not isinstance(content, str) or not content:
+        return None
+    return content[:ROUTING_PREFIX_CHARS]
+
+
+def estimate_tokens(request_body: Dict[str, Any]) -> int:
+    """Rough prompt plus completion size of a request, used for token-based balancing."""
+    prompt_chars = sum(
+        len(msg.get("content") or "") for msg in request_body.get("messages") or [] if isinstance(msg, dict)
+    )
+    return prompt_chars // 4 + (request_body.get("max_tokens") or 256)
+
+
+class Backend:
+    """One vLLM server and the gateway's view of its load and health."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = True
+        self.outstanding = 0
+        self.outstanding_tokens = 0
+        self.failures = 0
+        backend_healthy.set(1, (self.url,))
+
+    def load(self) -> int:
+        return self.outstanding_tokens if BACKEND_BALANCE == "tokens" else self.outstanding
+
+
+class BackendPool:
+    """
+    Routes requests across the configured vLLM servers.
+
+    Each request goes to the healthy backend with the fewest outstanding requests (or tokens,
+    with BACKEND_BALANCE=tokens). Requests that share a prompt prefix prefer the same backend,
+    chosen by rendezvous hashing, so its prefix cache stays warm while load allows.
+    Backends are ejected after repeated failed `/health` checks or connection errors and
+    readmitted on the next successful check.
+    """
+
+    def __init__(self, urls: List[str]):
+        self.backends = [Backend(url) for url in urls]
+        self._health_task: Optional[asyncio.Task] = None
+
+    def pick(self, key: Optional[str] = None, exclude: Optional[Backend] = None) -> Backend:
+        candidates = [b for b in self.backends if b.healthy and b is not exclude] or self.backends
+        if len(candidates) == 1:
+            return candidates[0]
+        least = min(candidates, key=Backend.load)
+        if key is None:
+            return least
+        # Walk the key's rendezvous ranking so overflow lands on the same few backends, too
+        bound = least.load() * STICKY_LOAD_FACTOR + STICKY_SLACK
+        ranked = sorted(candidates, key=lambda b: hashlib.blake2b(f"{b.url}|{key}".encode("utf-8"), digest_size=8).digest(), reverse=True)
+        return next(b for b in ranked if b.load() <= bound)
+
+    def acquire(self, backend: Backend, tokens: int):
+        backend.outstanding += 1
+        backend.outstanding_tokens += tokens
+        backend_outstanding.set(backend.outstanding, (backend.url,))
+
+    def release(self, backend: Backend, tokens: int, failed: bool):
+        """Ends a request. `failed` marks a connection-level failure, which counts toward ejection."""
+        backend.outstanding -= 1
+        backend.outstanding_tokens -= tokens
+        backend_outstanding.set(backend.outstanding, (backend.url,))
+        backend_requests.inc(1, (backend.url, "error" if failed else "ok"))
+        if failed:
+            self._record_failure(backend, "request failed")
+        else:
+            backend.failures = 0
+
+    def _record_failure(self, backend: Backend, reason: str):
+        backend.failures += 1
+        if backend.healthy and backend.failures >= UNHEALTHY_THRESHOLD:
+            backend.healthy = False
+            backend_healthy.set(0, (backend.url,))
+            logger.warning(f"Ejecting vLLM backend {backend.url} after {backend.failures} failures ({reason}).")
+
+    async def _check(self, backend: Backend):
+        try:
+            async with get_http_client().get(f"{backend.url}/health", timeout=BACKEND_HEALTH_TIMEOUT) as response:
+                ok = response.status == 200
+                reason = f"health check returned {response.status}"
+        except Exception as e:
+            ok = False
+            reason = f"health check failed: {e!r}"
+
+        if not ok:
+            self._record_failure(backend, reason)
+            return
+        backend.failures = 0
+        if not backend.healthy:
+            backend.healthy = True
+            backend_healthy.set(1, (backend.url,))
+            logger.info(f"vLLM backend {backend.url} is healthy again.")
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(backend) for backend in self.backends))
+            await asyncio.sleep(BACKEND_HEALTH_INTERVAL)
+
+    def start_health_checks(self):
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+            logger.info(f"Routing to {len(self.backends)} vLLM backend(s): {', '.join(b.url for b in self.backends)}.")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "url": b.url,
+                "healthy": b.healthy,
+                "outstanding": b.outstanding,
+                "outstanding_tokens": b.outstanding_tokens,
+            }
+            for b in self.backends
+        ]
+
+
+backend_pool = BackendPool(VLLM_URLS)
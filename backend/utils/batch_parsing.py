@@ -0,0 +1,170 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+from .config import BATCH_PARSE_PROCESSES
+from .file_index import index_path, load_line_offsets
+
+logger = logging.getLogger(__name__)
+
+# A shard ends after this many lines (when the input has a line index) or bytes, whichever comes first
+PARSE_SHARD_LINES = 4096
+PARSE_SHARD_BYTES = 1024 * 1024
+# Input bytes of the shards submitted to the pool ahead of the one being dispatched; rendered
+# prompts are about as large as the lines they come from, so this bounds their memory too
+PARSE_READAHEAD_BYTES = 4 * 1024 * 1024
+
+# A rendered line: (system prompt, prompt prefix shared by its template, hash of that prefix)
+RenderedLine = Tuple[str, str, bytes]
+# A parsed shard: the prefix of each template hash seen in it, once, and per line in order either
+# (system prompt, prefix hash) or the error message for the line
+ParsedShard = Tuple[Dict[bytes, str], List[Union[Tuple[str, bytes], str]]]
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def render_line(line: bytes) -> RenderedLine:
+    """
+    Parses one input line and renders its template. Raises ValueError on bad input.
+    Also returns the prompt prefix the line shares with every line using the same template.
+    """
+    request_data = _json.loads(line)
+    messages = request_data.get("messages", [])
+    system_message = next((msg for msg in messages if msg.get("role") == "system"), None)
+    user_message = next((msg for msg in messages if msg.get("role") == "user"), None)
+
+    if not system_message or not user_message:
+        raise ValueError("Missing system or user message in the input data.")
+
+    template = system_message.get("content", "")
+    data = user_message.get("content", "")
+
+    content = template.replace("<user_profile>", data).replace("<system_info>", "")
+    prefix = template.partition("<user_profile>")[0].replace("<system_info>", "")
+    key = hashlib.blake2b(prefix.encode("utf-8"), digest_size=16).digest()
+    return content, prefix, key
+
+
+def parse_shard(path: str, start: int, end: int) -> ParsedShard:
+    """
+    Renders every line in bytes [start, end) of `path`, which must begin at a line start.
+    Each template prefix is returned once per shard rather than with every line that uses it,
+    so it is pickled back from the worker process only once. Runs in a worker process.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    prefixes = {}
+    results = []
+    lines = data.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    for line in lines:
+        try:
+            content, prefix, key = render_line(line)
+        except (ValueError, AttributeError, TypeError) as e:
+            results.append(str(e) or type(e).__name__)
+            continue
+        prefixes.setdefault(key, prefix)
+        results.append((content, key))
+    return prefixes, results
+
+
+def _shard_bounds(path: str) -> List[int]:
+    """Byte offsets splitting `path` into shards at line starts, ending with the file size."""
+    if os.path.exists(index_path(path)):
+        offsets = load_line_offsets(path)
+        last = len(offsets) - 1
+        bounds = [0]
+        line = 0
+        while line < last:
+            # Stop at the line limit or at the first line starting past the byte limit, but
+            # always take at least one line
+            by_bytes = bisect.bisect_left(offsets, offsets[line] + PARSE_SHARD_BYTES, line + 1, last)
+            line = min(line + PARSE_SHARD_LINES, max(by_bytes, line + 1), last)
+            bounds.append(offsets[line])
+        return bounds
+
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        while bounds[-1] + PARSE_SHARD_BYTES < size:
+            f.seek(bounds[-1] + PARSE_SHARD_BYTES)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return bounds
+
+
+def _get_pool() -> Optional[Executor]:
+    global _pool
+    if _pool is None and BATCH_PARSE_PROCESSES > 0:
+        # Spawned, not forked: the gateway runs threads that a fork would copy mid-operation
+        _pool = ProcessPoolExecutor(BATCH_PARSE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"Started {BATCH_PARSE_PROCESSES} batch parsing processes.")
+    return _pool
+
+
+async def parse_batch_file(path: str) -> AsyncIterator[ParsedShard]:
+    """
+    Yields the parsed shards of a batch input file (see `parse_shard`), in file order.
+
+    Shards are cut at line starts (from the upload's line index when there is one) and parsed
+    ahead in the process pool, at most PARSE_READAHEAD_BYTES of input at a time, so the event
+    loop only assembles requests. With BATCH_PARSE_PROCESSES=0 shards are parsed in a worker
+    thread instead.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    bounds = await asyncio.to_thread(_shard_bounds, path)
+    shards = list(zip(bounds, bounds[1:]))
+    next_shard = 0
+
+    pending = deque()  # (future, input bytes of the shard)
+    submitted_bytes = 0
+
+    def submit_ahead():
+        # Always keep one shard in flight; add more while they fit in the readahead budget
+        nonlocal next_shard, submitted_bytes
+        while next_shard < len(shards):
+            start, end = shards[next_shard]
+            if pending and submitted_bytes + end - start > PARSE_READAHEAD_BYTES:
+                return
+            pending.append((loop.run_in_executor(pool, parse_shard, path, start, end), end - start))
+            submitted_bytes += end - start
+            next_shard += 1
+
+    try:
+        submit_ahead()
+        while pending:
+            future, size = pending.popleft()
+            shard = await future
+            submitted_bytes -= size
+            # Parse the next shards while this one is being dispatched
+            submit_ahead()
+            yield shard
+    finally:
+        # The consumer stopped early, e.g. on cancel: drop shards that have not started yet
+        for future, _ in pending:
+            future.cancel()
+
+
+def shutdown_parse_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
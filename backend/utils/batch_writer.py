@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BatchResultWriter:
+    """
+    Appends batch results to the output and error files from a dedicated thread.
+
+    Entries are dicts, serialized here, or complete JSON lines already encoded as bytes; they
+    are written in groups as they arrive. Both files are flushed and
+    fsynced at most every `fsync_interval` seconds, after which `on_durable(completed, failed,
+    prompt_tokens, completion_tokens)` is called on the event loop with the deltas that are now
+    safely on disk. A crash therefore loses at most the unsynced tail.
+
+    If writing fails, the thread stops and sets `failed`; later entries are discarded, so the
+    caller should stop producing them and report `error`.
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        error_path: str,
+        on_durable: Callable[[int, int, int, int], None],
+        fsync_interval: float = 1.0,
+    ):
+        self.output_path = output_path
+        self.error_path = error_path
+        self._on_durable = on_durable
+        self._fsync_interval = fsync_interval
+        self._loop = asyncio.get_running_loop()
+        self._queue = queue.SimpleQueue()
+        self._error: Optional[BaseException] = None
+        self.failed = asyncio.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            name=f"batch-writer-{os.path.basename(output_path)}",
+            daemon=True,
+        )
+
+    @property
+    def error(self) -> Optional[BaseException]:
+        """What stopped the writer thread, if it failed."""
+        return self._error
+
+    def start(self):
+        self._thread.start()
+
+    def write_output(self, entry: Union[Dict[str, Any], bytes], prompt_tokens: int = 0, completion_tokens: int = 0):
+        """Queues a successful result; it counts as completed once durable."""
+        self._queue.put(("output", entry, prompt_tokens, completion_tokens))
+
+    def write_error(self, entry: Union[Dict[str, Any], bytes]):
+        """Queues a failed result; it counts as failed once durable."""
+        self._queue.put(("error", entry, 0, 0))
+
+    async def close(self):
+        """Writes and fsyncs everything still queued, then stops the writer thread."""
+        self._queue.put(_STOP)
+        await asyncio.to_thread(self._thread.join)
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        try:
+            with open(self.output_path, "ab") as f_out, open(self.error_path, "ab") as f_err:
+                self._write_loop(f_out, f_err)
+        except BaseException as e:
+            logger.exception(f"Batch writer for {self.output_path} failed: {e}")
+            self._error = e
+            self._loop.call_soon_threadsafe(self.failed.set)
+
+    def _write_loop(self, f_out, f_err):
+        completed = failed = prompt_tokens = completion_tokens = 0
+        last_sync = time.monotonic()
+        stopping = False
+
+        while not stopping:
+            try:
+                items = [self._queue.get(timeout=self._fsync_interval)]
+            except queue.Empty:
+                items = []
+            # Group everything that is already waiting into a single write per file
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            output_lines = []
+            error_lines = []
+            for item in items:
+                if item is _STOP:
+                    stopping = True
+                    continue
+                kind, entry, item_prompt_tokens, item_completion_tokens = item
+                line = entry if isinstance(entry, bytes) else (json.dumps(entry) + "\n").encode("utf-8")
+                if kind == "output":
+                    output_lines.append(line)
+                    completed += 1
+                    prompt_tokens += item_prompt_tokens
+                    completion_tokens += item_completion_tokens
+                else:
+                    error_lines.append(line)
+                    failed += 1
+
+            if output_lines:
+                f_out.write(b"".join(output_lines))
+            if error_lines:
+                f_err.write(b"".join(error_lines))
+
+            now = time.monotonic()
+            if (completed or failed) and (stopping or now - last_sync >= self._fsync_interval):
+                for f in (f_out, f_err):
+                    f.flush()
+                    os.fsync(f.fileno())
+                last_sync = now
+                self._loop.call_soon_threadsafe(self._on_durable, completed, failed, prompt_tokens, completion_tokens)
+                completed = failed = prompt_tokens = completion_tokens = 0
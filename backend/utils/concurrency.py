@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import statistics
+import time
+from typing import Dict, List, Optional
+
+from .backends import Backend, backend_pool
+from .http_client import get_http_client
+from .metrics import Counter, Gauge
+from .vllm_queue import ConcurrencyLimit, VLLMRequest, add_completion_listener
+from .passthrough import body_usage
+
+logger = logging.getLogger(__name__)
+
+# How often the controller re-evaluates the limit, and how many completions a window needs
+# before its latency is trusted.
+CONTROL_INTERVAL = 2.0
+MIN_WINDOW_SAMPLES = 20
+
+# Additive step once out of slow start, and the factor applied on every decrease.
+INCREASE_STEP = 8
+DECREASE_FACTOR = 0.7
+# Minimum time between two decreases, so requests started under the old limit can drain.
+DECREASE_COOLDOWN = 3 * CONTROL_INTERVAL
+
+# A window is congested when its median time per output token exceeds the best median seen so
+# far by this factor. The baseline drifts up slowly so a model or hardware change can re-settle.
+LATENCY_TOLERANCE = 2.0
+BASELINE_DRIFT = 0.01
+MAX_ERROR_RATE = 0.05
+# Interactive requests share the backend; back off when their median latency degrades.
+INTERACTIVE_LATENCY_TOLERANCE = 1.5
+INTERACTIVE_MIN_SAMPLES = 5
+
+# vLLM engine signals, read from its Prometheus endpoint when it exposes one.
+VLLM_METRICS_TIMEOUT = 1.0
+KV_CACHE_HIGH = 0.95
+VLLM_WAITING_HIGH_RATIO = 0.25
+
+concurrency_limit = Gauge(
+    "gateway_concurrency_limit",
+    "Current adaptive limit on requests in flight upstream.",
+    labelnames=("queue",),
+)
+concurrency_adjustments = Counter(
+    "gateway_concurrency_adjustments_total",
+    "Changes made by the adaptive concurrency controller.",
+    labelnames=("queue", "direction", "reason"),
+)
+
+
+def parse_vllm_metrics(text: str) -> Dict[str, float]:
+    """Sums the samples of each metric in a Prometheus text exposition across their labels."""
+    values: Dict[str, float] = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name_and_labels, _, value = line.rpartition(" ")
+        name = name_and_labels.split("{", 1)[0]
+        try:
+            values[name] = values.get(name, 0.0) + float(value)
+        except ValueError:
+            continue
+    return values
+
+
+class _Window:
+    """Completions observed for one queue since the last control tick."""
+
+    def __init__(self):
+        self.samples: List[float] = []
+        self.errors = 0
+        self.total = 0
+
+    def add(self, request: VLLMRequest, upstream_seconds: float):
+        if not request.future.done() or request.future.cancelled():
+            # Abandoned by its caller (e.g. a cancelled batch): the upstream outcome is unknown
+            return
+        self.total += 1
+        result = request.future.result()
+        status = result["status_code"]
+        # Upstream 5xx, including timeouts and connection failures, and rate limiting
+        if status >= 500 or status == 429:
+            self.errors += 1
+            return
+        if status != 200:
+            # Client errors such as over-long prompts say nothing about backend load
+            return
+        usage = body_usage(result["body"])
+        completion_tokens = (usage or {}).get("completion_tokens") or 0
+        # Normalize by output length so a run of long generations does not look like congestion
+        self.samples.append(upstream_seconds / max(1, completion_tokens))
+
+
+class AIMDController:
+    """
+    Tunes a `ConcurrencyLimit` with additive-increase/multiplicative-decrease.
+
+    Every `CONTROL_INTERVAL` seconds the limit is cut by `DECREASE_FACTOR` when the window saw
+    upstream errors, a latency blow-up, vLLM preemptions or a growing vLLM waiting queue, or
+    when interactive latency degraded. Otherwise, if the dispatcher was held back by the limit,
+    it grows: doubling until the first decrease (slow start), then by `INCREASE_STEP`.
+    """
+
+    def __init__(self, queue_name: str, limit: ConcurrencyLimit, min_limit: int, max_limit: int, interactive_queue_name: str = "interactive"):
+        self.queue_name = queue_name
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.interactive_queue_name = interactive_queue_name
+        self._window = _Window()
+        self._interactive = _Window()
+        self._baseline: Optional[float] = None
+        self._interactive_baseline: Optional[float] = None
+        self._slow_start = True
+        self._last_decrease = 0.0
+        self._vllm_metrics_available = True
+        self._last_preemptions: Optional[float] = None
+        concurrency_limit.set(limit.limit, (queue_name,))
+
+    def observe(self, queue_name: str, request: VLLMRequest, upstream_seconds: float):
+        if queue_name == self.queue_name:
+            self._window.add(request, upstream_seconds)
+        elif queue_name == self.interactive_queue_name:
+            self._interactive.add(request, upstream_seconds)
+
+    async def run(self):
+        logger.info(
+            f"Adaptive concurrency for queue {self.queue_name} started "
+            f"(limit={self.limit.limit}, range={self.min_limit}-{self.max_limit})."
+        )
+        while True:
+            await asyncio.sleep(CONTROL_INTERVAL)
+            try:
+                await self._tick()
+            except Exception as e:
+                logger.error(f"Adaptive concurrency tick for queue {self.queue_name} failed: {e}")
+
+    async def _tick(self):
+        window, self._window = self._window, _Window()
+        interactive, self._interactive = self._interactive, _Window()
+        saturated, self.limit.saturated = self.limit.saturated, False
+        engine = await self._read_vllm_metrics()
+
+        reason = self._congestion_reason(window, interactive, engine)
+        if reason is not None:
+            if time.monotonic() - self._last_decrease >= DECREASE_COOLDOWN:
+                self._slow_start = False
+                self._last_decrease = time.monotonic()
+                self._set(max(self.min_limit, int(self.limit.limit * DECREASE_FACTOR)), "down", reason)
+            return
+
+        if not saturated or self._holding(engine):
+            return
+        step = self.limit.limit if self._slow_start else INCREASE_STEP
+        self._set(min(self.max_limit, self.limit.limit + step), "up", "slow_start" if self._slow_start else "headroom")
+
+    def _congestion_reason(self, window: _Window, interactive: _Window, engine: Dict[str, float]) -> Optional[str]:
+        if window.total >= MIN_WINDOW_SAMPLES and window.errors / window.total > MAX_ERROR_RATE:
+            return "errors"
+
+        preemptions = engine.get("vllm:num_preemptions_total")
+        if preemptions is not None:
+            preempted = self._last_preemptions is not None and preemptions > self._last_preemptions
+            self._last_preemptions = preemptions
+            if preempted:
+                return "preemption"
+
+        waiting = engine.get("vllm:num_requests_waiting")
+        if waiting is not None and waiting > VLLM_WAITING_HIGH_RATIO * self.limit.limit:
+            return "vllm_waiting"
+
+        if len(window.samples) >= MIN_WINDOW_SAMPLES:
+            median = statistics.median(window.samples)
+            self._baseline = median if self._baseline is None else min(self._baseline * (1 + BASELINE_DRIFT), median)
+            if median > self._baseline * LATENCY_TOLERANCE:
+                return "latency"
+
+        if len(interactive.samples) >= INTERACTIVE_MIN_SAMPLES:
+            median = statistics.median(interactive.samples)
+            baseline = self._interactive_baseline
+            self._interactive_baseline = median if baseline is None else min(baseline * (1 + BASELINE_DRIFT), median)
+            if median > self._interactive_baseline * INTERACTIVE_LATENCY_TOLERANCE:
+                return "interactive_latency"
+        return None
+
+    def _holding(self, engine: Dict[str, float]) -> bool:
+        """True when vLLM reports no spare capacity, so growing the limit would only queue there."""
+        kv_usage = engine.get("vllm:kv_cache_usage_perc", engine.get("vllm:gpu_cache_usage_perc"))
+        if kv_usage is not None and kv_usage >= KV_CACHE_HIGH:
+            return True
+        return engine.get("vllm:num_requests_waiting", 0) > 0
+
+    def _set(self, new_limit: int, direction: str, reason: str):
+        if new_limit == self.limit.limit:
+            return
+        logger.info(f"Adaptive concurrency for queue {self.queue_name}: {self.limit.limit} -> {new_limit} ({reason}).")
+        self.limit.set_limit(new_limit)
+        concurrency_limit.set(new_limit, (self.queue_name,))
+        concurrency_adjustments.inc(1, (self.queue_name, direction, reason))
+
+    async def _read_vllm_metrics(self) -> Dict[str, float]:
+        """Reads every healthy backend: counts are summed, `_perc` gauges take the worst backend."""
+        if not self._vllm_metrics_available:
+            return {}
+        combined: Dict[str, float] = {}
+        for values in await asyncio.gather(*(self._read_backend_metrics(b) for b in backend_pool.backends if b.healthy)):
+            for name, value in values.items():
+                if name.endswith("_perc"):
+                    combined[name] = max(combined.get(name, 0.0), value)
+                else:
+                    combined[name] = combined.get(name, 0.0) + value
+        return combined
+
+    async def _read_backend_metrics(self, backend: Backend) -> Dict[str, float]:
+        try:
+            async with get_http_client().get(f"{backend.url}/metrics", timeout=VLLM_METRICS_TIMEOUT) as response:
+                if response.status == 404:
+                    logger.info(f"vLLM backend {backend.url} exposes no /metrics endpoint; adapting on gateway-side signals only.")
+                    self._vllm_metrics_available = False
+                    return {}
+                if response.status != 200:
+                    return {}
+                return parse_vllm_metrics(await response.text())
+        except Exception as e:
+            logger.debug(f"Could not read vLLM metrics from {backend.url}: {e}")
+            return {}
+
+
+def start_adaptive_concurrency(queue_name: str, limit: ConcurrencyLimit, min_limit: int, max_limit: int) -> AIMDController:
+    """Starts an AIMD controller for `limit` as a background task and returns it."""
+    controller = AIMDController(queue_name, limit, min_limit, max_limit)
+    add_completion_listener(controller.observe)
+    asyncio.create_task(controller.run())
+    return controller
@@ -5,3 +5,63 @@ load_dotenv()
 
 VLLM_URL = os.getenv("VLLM_URL", "http://vllm:8000")
 API_TOKEN = os.getenv("API_TOKEN")
+# Serve the Prometheus /metrics endpoint without API_TOKEN, e.g. for an in-cluster scraper
+METRICS_AUTH_EXEMPT = os.getenv("METRICS_AUTH_EXEMPT", "").lower() in ("1", "true", "yes")
+
+# Pool of vLLM servers, comma-separated; defaults to VLLM_URL alone. BACKEND_BALANCE picks the
+# load measure for least-outstanding routing: "requests" or "tokens".
+VLLM_URLS = [url.strip() for url in os.getenv("VLLM_URLS", VLLM_URL).split(",") if url.strip()]
+BACKEND_BALANCE = os.getenv("BACKEND_BALANCE", "requests")
+BACKEND_HEALTH_INTERVAL = float(os.getenv("BACKEND_HEALTH_INTERVAL", "5"))
+BACKEND_HEALTH_TIMEOUT = float(os.getenv("BACKEND_HEALTH_TIMEOUT", "2"))
+
+# Timeouts (seconds)
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "180"))
+INTERACTIVE_QUEUE_TIMEOUT = float(os.getenv("INTERACTIVE_QUEUE_TIMEOUT", "30"))
+INTERACTIVE_GENERATION_TIMEOUT = float(os.getenv("INTERACTIVE_GENERATION_TIMEOUT", "180"))
+
+# Carry successful non-streaming upstream bodies through the gateway as raw bytes: only `usage`
+# is decoded, chat clients get vLLM's bytes unchanged and batch output lines embed them as is
+UPSTREAM_PASSTHROUGH = os.getenv("UPSTREAM_PASSTHROUGH", "true").lower() in ("1", "true", "yes")
+
+# Admission control for chat requests: beyond INTERACTIVE_MAX_QUEUED waiting requests new ones
+# get a 429, and a stream that finds no free slot within STREAM_ADMISSION_TIMEOUT is shed too
+INTERACTIVE_MAX_QUEUED = int(os.getenv("INTERACTIVE_MAX_QUEUED", "256"))
+STREAM_ADMISSION_TIMEOUT = float(os.getenv("STREAM_ADMISSION_TIMEOUT", "2"))
+
+# Request tracing: requests slower than SLOW_REQUEST_THRESHOLD seconds (0 disables) have their
+# lifecycle dumped to the "gateway.slow_requests" logger, or to TRACE_DUMP_PATH as JSON lines.
+# PROFILER_SAMPLE_INTERVAL > 0 also samples the event loop's stack and attaches it to each dump.
+SLOW_REQUEST_THRESHOLD = float(os.getenv("SLOW_REQUEST_THRESHOLD", "0"))
+PROFILER_SAMPLE_INTERVAL = float(os.getenv("PROFILER_SAMPLE_INTERVAL", "0"))
+TRACE_DUMP_PATH = os.getenv("TRACE_DUMP_PATH")
+
+# Shared upstream connection pool
+UPSTREAM_CONNECTION_LIMIT = int(os.getenv("UPSTREAM_CONNECTION_LIMIT", "512"))
+UPSTREAM_CONNECTION_LIMIT_PER_HOST = int(os.getenv("UPSTREAM_CONNECTION_LIMIT_PER_HOST", "0"))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", "75"))
+UPSTREAM_DNS_CACHE_TTL = int(os.getenv("UPSTREAM_DNS_CACHE_TTL", "300"))
+
+# Tokenizer used for truncation. TOKENIZER_PATH may point to a local model directory or a
+# serialized tokenizer.json; with TOKENIZER_OFFLINE set, nothing is fetched from the hub.
+TOKENIZER_NAME = os.getenv("TOKENIZER_NAME", "Qwen/Qwen3-4b-FP8")
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH")
+TOKENIZER_OFFLINE = os.getenv("TOKENIZER_OFFLINE", "").lower() in ("1", "true", "yes")
+
+# Processes parsing and rendering batch input files; 0 parses in a worker thread instead
+BATCH_PARSE_PROCESSES = int(os.getenv("BATCH_PARSE_PROCESSES", str(min(4, os.cpu_count() or 1))))
+
+# Write a gzip copy of every finished batch output/error file, served by
+# GET /v1/files/{file_id}/content to clients that accept gzip
+PRECOMPRESS_OUTPUT_FILES = os.getenv("PRECOMPRESS_OUTPUT_FILES", "").lower() in ("1", "true", "yes")
+
+# SQLite database holding file and batch metadata across restarts
+METADATA_DB_PATH = os.getenv("METADATA_DB_PATH", os.path.join("batch_files", "metadata.db"))
+
+# Optional response cache for deterministic requests (temperature 0 or a fixed seed).
+# RESPONSE_CACHE_SAMPLED also caches sampled responses, e.g. to replay retried batches.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DISK_PATH = os.getenv("RESPONSE_CACHE_DISK_PATH")
+RESPONSE_CACHE_SAMPLED = os.getenv("RESPONSE_CACHE_SAMPLED", "").lower() in ("1", "true", "yes")
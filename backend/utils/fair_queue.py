@@ -0,0 +1,145 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Dict, Hashable, Iterator, Tuple
+
+from .metrics import Counter, Gauge
+
+# Flow used for items that do not carry one, e.g. requests not belonging to a batch
+DEFAULT_FLOW: Tuple[str, str] = ("", "")
+
+flow_dispatched = Counter(
+    "gateway_flow_dispatched_total",
+    "Requests handed to a dispatcher by the fair scheduler, per tenant and batch.",
+    labelnames=("tenant", "flow"),
+)
+flow_queued = Gauge(
+    "gateway_flow_queued",
+    "Requests waiting in the fair scheduler, per tenant and batch.",
+    labelnames=("tenant", "flow"),
+)
+
+
+class _Node:
+    __slots__ = ("weight", "deficit", "children")
+
+    def __init__(self, weight: float, children):
+        self.weight = weight
+        self.deficit = 0.0
+        self.children = children
+
+
+def _next_in_round(ring: "OrderedDict[Hashable, _Node]") -> _Node:
+    """
+    Deficit round-robin over `ring` for unit-cost items: the node at the head is served while
+    it has at least one unit of credit and moves to the back once its turn is used up. Every
+    turn adds `weight` credit, so weights below one skip rounds and fractions carry over.
+    """
+    while True:
+        key, node = next(iter(ring.items()))
+        if node.deficit < 1:
+            node.deficit += node.weight
+            if node.deficit < 1:
+                ring.move_to_end(key)
+                continue
+        node.deficit -= 1
+        if node.deficit < 1:
+            ring.move_to_end(key)
+        return node
+
+
+class _FlowTree:
+    """
+    Per-tenant, per-flow FIFOs served by two levels of deficit round-robin: tenants share the
+    queue equally, and each tenant's share is split between its flows by their weights.
+    Implements the `append`/`popleft`/`len` surface that `asyncio.Queue` expects of `_queue`.
+    """
+
+    def __init__(self):
+        self._tenants: "OrderedDict[str, _Node]" = OrderedDict()
+        self._size = 0
+
+    def append(self, item: Any):
+        tenant, flow = getattr(item, "flow", None) or DEFAULT_FLOW
+        tenant_node = self._tenants.get(tenant)
+        if tenant_node is None:
+            tenant_node = self._tenants[tenant] = _Node(1.0, OrderedDict())
+        flow_node = tenant_node.children.get(flow)
+        if flow_node is None:
+            flow_node = tenant_node.children[flow] = _Node(getattr(item, "weight", 1.0), deque())
+        flow_node.children.append(item)
+        self._size += 1
+        flow_queued.inc(1, (tenant, flow))
+
+    def popleft(self) -> Any:
+        if not self._size:
+            raise IndexError("pop from an empty FairQueue")
+        tenant_node = _next_in_round(self._tenants)
+        flow_node = _next_in_round(tenant_node.children)
+        item = flow_node.children.popleft()
+        self._size -= 1
+
+        tenant, flow = getattr(item, "flow", None) or DEFAULT_FLOW
+        labels = (tenant, flow)
+        flow_queued.dec(1, labels)
+        flow_dispatched.inc(1, labels)
+        # Idle flows and tenants leave the round and forfeit their credit, as in plain DRR
+        if not flow_node.children:
+            del tenant_node.children[flow]
+            if not tenant_node.children:
+                del self._tenants[tenant]
+        return item
+
+    def remove_flow(self, tenant: str, flow: str) -> int:
+        """Drops every item still queued for a flow and returns how many there were."""
+        tenant_node = self._tenants.get(tenant)
+        flow_node = tenant_node.children.pop(flow, None) if tenant_node else None
+        if flow_node is None:
+            return 0
+        if not tenant_node.children:
+            del self._tenants[tenant]
+        dropped = len(flow_node.children)
+        self._size -= dropped
+        return dropped
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Any]:
+        for tenant_node in self._tenants.values():
+            for flow_node in tenant_node.children.values():
+                yield from flow_node.children
+
+    def stats(self) -> Dict[str, Dict[str, dict]]:
+        return {
+            tenant: {
+                flow: {"queued": len(node.children), "weight": node.weight}
+                for flow, node in tenant_node.children.items()
+            }
+            for tenant, tenant_node in self._tenants.items()
+        }
+
+
+class FairQueue(asyncio.Queue):
+    """
+    An `asyncio.Queue` that serves items fairly across flows instead of in arrival order.
+
+    Items carry `flow = (tenant, flow_id)` and `weight`. A flow's weight is taken from its first
+    queued item. Consumers use the normal queue API, so the dispatchers need no changes.
+    """
+
+    def _init(self, maxsize):
+        self._queue = _FlowTree()
+
+    def stats(self) -> Dict[str, Dict[str, dict]]:
+        """Returns queued requests and weight per tenant and flow."""
+        return self._queue.stats()
+
+    def drop_flow(self, tenant: str, flow: str):
+        """
+        Discards whatever a finished or cancelled flow still has queued and drops its metric
+        series, so per-batch labels do not accumulate.
+        """
+        for _ in range(self._queue.remove_flow(tenant, flow)):
+            self.task_done()
+        flow_dispatched.remove((tenant, flow))
+        flow_queued.remove((tenant, flow))
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+from array import array
+from dataclasses import dataclass
+
+# Line offsets are stored next to each uploaded file as native unsigned 64-bit integers
+INDEX_SUFFIX = ".idx"
+_OFFSET_TYPECODE = "Q"
+
+
+@dataclass
+class FileIndexStats:
+    bytes: int
+    line_count: int
+    invalid_lines: int
+    checksum: str
+
+
+def index_path(file_path: str) -> str:
+    return file_path + INDEX_SUFFIX
+
+
+def _is_valid_line(line: bytes) -> bool:
+    try:
+        return isinstance(json.loads(line), dict)
+    except ValueError:
+        return False
+
+
+class IndexedFileWriter:
+    """
+    Writes a file chunk by chunk and, in the same pass, records the byte offset of every line,
+    counts lines that are not JSON objects and computes a SHA-256.
+
+    The index file holds one offset per line plus the file size, so line i spans
+    offsets[i]:offsets[i + 1]. Every method does blocking I/O; call them from a worker thread.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._digest = hashlib.sha256()
+        self._position = self._line_count = self._invalid_lines = 0
+        # Bytes of a line that started in an earlier chunk and has not ended yet
+        self._partial = bytearray()
+        self._out = open(file_path, "wb")
+        try:
+            self._index = open(index_path(file_path), "wb")
+        except BaseException:
+            self._out.close()
+            remove_indexed(file_path)
+            raise
+
+    def write(self, chunk: bytes):
+        self._out.write(chunk)
+        self._digest.update(chunk)
+
+        offsets = array(_OFFSET_TYPECODE)
+        partial = self._partial
+        start = 0
+        while True:
+            newline = chunk.find(b"\n", start)
+            if newline == -1:
+                break
+            if partial:
+                line_start = self._position - len(partial)
+                partial += chunk[start:newline + 1]
+                line = bytes(partial)
+                partial.clear()
+            else:
+                line_start = self._position + start
+                line = chunk[start:newline + 1]
+            offsets.append(line_start)
+            self._line_count += 1
+            if not _is_valid_line(line):
+                self._invalid_lines += 1
+            start = newline + 1
+        partial += chunk[start:]
+        self._position += len(chunk)
+        offsets.tofile(self._index)
+
+    def finish(self) -> FileIndexStats:
+        """Indexes a last line without a trailing newline, closes both files and returns the stats."""
+        try:
+            tail = array(_OFFSET_TYPECODE)
+            if self._partial:
+                tail.append(self._position - len(self._partial))
+                self._line_count += 1
+                if not _is_valid_line(bytes(self._partial)):
+                    self._invalid_lines += 1
+            tail.append(self._position)
+            tail.tofile(self._index)
+            self._out.close()
+            self._index.close()
+        except BaseException:
+            self.abort()
+            raise
+
+        return FileIndexStats(
+            bytes=self._position,
+            line_count=self._line_count,
+            invalid_lines=self._invalid_lines,
+            checksum=f"sha256:{self._digest.hexdigest()}",
+        )
+
+    def abort(self):
+        """Closes and removes the file and its index."""
+        self._out.close()
+        self._index.close()
+        remove_indexed(self.file_path)
+
+
+def remove_indexed(file_path: str):
+    """Removes a file and its line index, whichever of them exist."""
+    for path in (file_path, index_path(file_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_line_offsets(file_path: str) -> array:
+    """Reads a file's line index: the start of every line followed by the file size."""
+    offsets = array(_OFFSET_TYPECODE)
+    with open(index_path(file_path), "rb") as f:
+        offsets.frombytes(f.read())
+    return offsets
@@ -0,0 +1,76 @@
+from typing import Dict, Optional
+import aiohttp
+import logging
+
+from .config import (
+    UPSTREAM_CONNECTION_LIMIT,
+    UPSTREAM_CONNECTION_LIMIT_PER_HOST,
+    UPSTREAM_KEEPALIVE_TIMEOUT,
+    UPSTREAM_DNS_CACHE_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def start_http_client() -> aiohttp.ClientSession:
+    """
+    Creates the app-lifetime upstream session shared by the queue consumers and the streaming proxy.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        return _session
+
+    connector = aiohttp.TCPConnector(
+        limit=UPSTREAM_CONNECTION_LIMIT,
+        limit_per_host=UPSTREAM_CONNECTION_LIMIT_PER_HOST,
+        keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    # Per-request timeouts are passed at the call site; streams may legitimately run long.
+    _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+    logger.info(
+        f"Upstream connection pool started (limit={UPSTREAM_CONNECTION_LIMIT}, "
+        f"limit_per_host={UPSTREAM_CONNECTION_LIMIT_PER_HOST}, keepalive={UPSTREAM_KEEPALIVE_TIMEOUT}s)."
+    )
+    return _session
+
+
+async def close_http_client():
+    """Closes the shared upstream session and all pooled connections."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("Upstream connection pool closed.")
+    _session = None
+
+
+def get_http_client() -> aiohttp.ClientSession:
+    """Returns the shared upstream session. `start_http_client` must have been awaited first."""
+    if _session is None or _session.closed:
+        raise RuntimeError("Upstream HTTP client is not running; call start_http_client() on startup.")
+    return _session
+
+
+def get_pool_stats() -> Dict[str, int]:
+    """
+    Returns a snapshot of the upstream connection pool.
+
+    `idle` counts keep-alive connections parked in the pool, `acquired` counts connections
+    currently carrying a request, and `open` is their sum.
+    """
+    if _session is None or _session.closed:
+        return {"open": 0, "idle": 0, "acquired": 0, "limit": UPSTREAM_CONNECTION_LIMIT}
+
+    connector = _session.connector
+    # aiohttp does not expose pool occupancy publicly; read it from the connector's bookkeeping.
+    idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+    acquired = len(getattr(connector, "_acquired", ()))
+    return {
+        "open": idle + acquired,
+        "idle": idle,
+        "acquired": acquired,
+        "limit": connector.limit,
+    }
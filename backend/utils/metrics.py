@@ -0,0 +1,189 @@
+import bisect
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+# Buckets (seconds) suited to gateway-side waits and upstream calls.
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 180.0,
+)
+
+_registry: List["_Metric"] = []
+_registry_lock = threading.Lock()
+# Called before every snapshot/scrape to refresh values that are cheaper to read than to track
+_collect_hooks: List[Callable[[], None]] = []
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        with _registry_lock:
+            _registry.append(self)
+
+
+class Counter(_Metric):
+    """A monotonically increasing value, optionally split by label values."""
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, description, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, labels: Tuple[str, ...] = ()):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, labels: Tuple[str, ...] = ()) -> float:
+        return self._values.get(labels, 0.0)
+
+    def remove(self, labels: Tuple[str, ...]):
+        """Drops one label combination, e.g. a per-batch series once the batch is done."""
+        self._values.pop(labels, None)
+
+    def samples(self):
+        return list(self._values.items())
+
+
+class Gauge(_Metric):
+    """A value that can go up and down."""
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, description, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, labels: Tuple[str, ...] = ()):
+        self._values[labels] = value
+
+    def inc(self, amount: float = 1.0, labels: Tuple[str, ...] = ()):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, labels: Tuple[str, ...] = ()):
+        self._values[labels] = self._values.get(labels, 0.0) - amount
+
+    def value(self, labels: Tuple[str, ...] = ()) -> float:
+        return self._values.get(labels, 0.0)
+
+    def remove(self, labels: Tuple[str, ...]):
+        """Drops one label combination, e.g. a per-batch series once the batch is done."""
+        self._values.pop(labels, None)
+
+    def samples(self):
+        return list(self._values.items())
+
+
+class Histogram(_Metric):
+    """
+    A fixed-bucket histogram. `observe` is a bisect plus three increments, so it is cheap
+    enough for the request path.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, labels: Tuple[str, ...] = ()) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def quantile(self, q: float, labels: Tuple[str, ...] = ()) -> Optional[float]:
+        """Returns the upper bound of the bucket containing the q-th quantile."""
+        series = self._series.get(labels)
+        if not series or not series[2]:
+            return None
+        rank = q * series[2]
+        running = 0
+        for i, bucket_count in enumerate(series[0]):
+            running += bucket_count
+            if running >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def samples(self):
+        return list(self._series.items())
+
+
+def add_collect_hook(hook: Callable[[], None]):
+    """Registers a function that updates gauges right before metrics are read."""
+    _collect_hooks.append(hook)
+
+
+def _collect():
+    for hook in _collect_hooks:
+        hook()
+
+
+def snapshot() -> Dict[str, dict]:
+    """Returns a JSON-friendly summary of every registered metric."""
+    _collect()
+    result = {}
+    for metric in list(_registry):
+        series = {}
+        for labels, value in metric.samples():
+            key = ",".join(f"{n}={v}" for n, v in zip(metric.labelnames, labels)) or "_"
+            if isinstance(metric, Histogram):
+                count, total = value[2], value[1]
+                series[key] = {
+                    "count": count,
+                    "sum": round(total, 6),
+                    "avg": round(total / count, 6) if count else None,
+                    "p50": metric.quantile(0.5, labels),
+                    "p99": metric.quantile(0.99, labels),
+                }
+            else:
+                series[key] = value
+        result[metric.name] = series
+    return result
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def render_prometheus() -> str:
+    """Renders every registered metric in the Prometheus text exposition format (0.0.4)."""
+    _collect()
+    lines = []
+    for metric in list(_registry):
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for labels, value in metric.samples():
+            if isinstance(metric, Histogram):
+                bucket_counts, total, count = value
+                running = 0
+                for bound, bucket_count in zip(metric.buckets + (float("inf"),), bucket_counts):
+                    running += bucket_count
+                    bucket_labels = _format_labels(metric.labelnames + ("le",), labels + (_format_value(bound),))
+                    lines.append(f"{metric.name}_bucket{bucket_labels} {running}")
+                label_text = _format_labels(metric.labelnames, labels)
+                lines.append(f"{metric.name}_sum{label_text} {_format_value(total)}")
+                lines.append(f"{metric.name}_count{label_text} {count}")
+            else:
+                lines.append(f"{metric.name}{_format_labels(metric.labelnames, labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
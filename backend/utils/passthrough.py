@@ -0,0 +1,76 @@
+import json
+from typing import Any, Dict, Optional
+
+_USAGE_KEY = b'"usage"'
+_decoder = json.JSONDecoder()
+
+
+class RawJSON:
+    """
+    An upstream JSON body kept as the bytes vLLM sent, with only its `usage` decoded. Routes
+    relay `data` as is instead of decoding and re-encoding the whole completion.
+    """
+
+    __slots__ = ("data", "usage")
+
+    def __init__(self, data: bytes, usage: Optional[Dict[str, Any]]):
+        self.data = data
+        self.usage = usage
+
+    def parsed(self) -> Any:
+        """Fully decodes the body, for the rare consumer that needs more than `usage`."""
+        return json.loads(self.data)
+
+
+def _extract_usage(data: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Decodes just the value of the last `"usage"` key. vLLM writes it after the choices, so only
+    the tail of the body is looked at. Returns None if the key is not found that way.
+    """
+    position = data.rfind(_USAGE_KEY)
+    if position == -1:
+        return None
+    tail = data[position + len(_USAGE_KEY):].decode("utf-8").lstrip()
+    if not tail.startswith(":"):
+        return None
+    try:
+        value, _ = _decoder.raw_decode(tail[1:].lstrip())
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def from_upstream(data: bytes) -> RawJSON:
+    """Wraps a successful upstream body. Raises ValueError if the body is not JSON."""
+    usage = _extract_usage(data)
+    if usage is None:
+        # Nothing found cheaply: fall back to a full parse, which also validates the body
+        parsed = json.loads(data)
+        usage = parsed.get("usage") if isinstance(parsed, dict) else None
+        usage = usage if isinstance(usage, dict) else None
+    return RawJSON(data, usage)
+
+
+def body_usage(body: Any) -> Optional[Dict[str, Any]]:
+    """Returns the `usage` of a decoded or raw upstream body, if it has one."""
+    if isinstance(body, RawJSON):
+        return body.usage
+    usage = body.get("usage") if isinstance(body, dict) else None
+    return usage if isinstance(usage, dict) else None
+
+
+def json_default(value: Any) -> Any:
+    """`default` for `json.dumps` calls that may meet a `RawJSON` body."""
+    if isinstance(value, RawJSON):
+        return value.parsed()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def compact(data: bytes) -> bytes:
+    """
+    Makes a JSON document safe to embed in a JSON Lines file. Raw newlines can only be
+    insignificant whitespace in JSON, so replacing them keeps the document intact.
+    """
+    if b"\n" in data or b"\r" in data:
+        return data.replace(b"\r", b" ").replace(b"\n", b" ")
+    return data
@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from .config import (
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_DISK_PATH,
+    RESPONSE_CACHE_SAMPLED,
+)
+from .metrics import Counter
+from .vllm_queue import VLLMRequest
+from .passthrough import json_default
+
+logger = logging.getLogger(__name__)
+
+# Body fields that do not influence the generated output
+_IGNORED_FIELDS = ("priority", "user")
+
+cache_requests = Counter(
+    "gateway_response_cache_requests_total",
+    "Response cache outcomes: hit, disk_hit, coalesced (joined an identical in-flight request), miss or bypass.",
+    labelnames=("route", "result"),
+)
+
+
+def cache_key(request: VLLMRequest) -> Optional[str]:
+    """Returns a canonical hash of the request, or None if its output is not reproducible."""
+    body = request.request_body
+    if body.get("stream"):
+        return None
+    if not RESPONSE_CACHE_SAMPLED and body.get("temperature") != 0 and body.get("seed") is None:
+        return None
+    canonical = {k: v for k, v in body.items() if k not in _IGNORED_FIELDS}
+    payload = json.dumps([request.vllm_endpoint, canonical], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _DiskTier:
+    """Cached responses in a local SQLite file, accessed from a single background thread."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        self._puts = 0
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._conn.execute(
+            "SELECT data FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put(self, key: str, result: Dict[str, Any], ttl: float):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, expires_at, data) VALUES (?, ?, ?)",
+            (key, time.time() + ttl, json.dumps(result, default=json_default)),
+        )
+        self._puts += 1
+        if self._puts % 1000 == 0:
+            self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._get, key)
+
+    def put(self, key: str, result: Dict[str, Any], ttl: float):
+        self._executor.submit(self._put, key, result, ttl)
+
+
+@dataclass
+class _InFlight:
+    leader: VLLMRequest
+    queue: asyncio.Queue
+    followers: List[VLLMRequest] = field(default_factory=list)
+
+
+class ResponseCache:
+    """
+    An LRU of successful upstream results bounded by entry count and TTL, with an optional
+    on-disk tier. Identical requests arriving while one is in flight share its result.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, disk_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, result)
+        self._inflight: Dict[str, _InFlight] = {}
+        self._disk = _DiskTier(disk_path) if disk_path else None
+
+    def _get_memory(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _put_memory(self, key: str, result: Dict[str, Any]):
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _on_leader_done(self, key: str, future: asyncio.Future):
+        entry = self._inflight.pop(key, None)
+        if entry is None:
+            return
+        if future.cancelled():
+            # The leader's caller gave up; hand the upstream call to the next waiting follower
+            waiting = [req for req in entry.followers if not req.future.done()]
+            if waiting:
+                self._lead(key, waiting[0], entry.queue, waiting[1:])
+                entry.queue.put_nowait(waiting[0])
+            return
+
+        result = future.result()
+        if result.get("status_code") == 200:
+            self._put_memory(key, result)
+            if self._disk is not None:
+                self._disk.put(key, result, self.ttl)
+        for req in entry.followers:
+            if not req.future.done():
+                req.future.set_result(result)
+
+    def _lead(self, key: str, request: VLLMRequest, queue: asyncio.Queue, followers: List[VLLMRequest]):
+        self._inflight[key] = _InFlight(request, queue, followers)
+        request.future.add_done_callback(lambda future: self._on_leader_done(key, future))
+
+    async def resolve(self, request: VLLMRequest, queue: asyncio.Queue, route: str, counts: Optional[Dict[str, int]] = None) -> bool:
+        """
+        Answers `request` from the cache or attaches it to an identical in-flight request.
+        Returns False if the caller still has to put it on `queue`.
+        """
+        key = cache_key(request)
+        if key is None:
+            outcome = "bypass"
+        else:
+            result = self._get_memory(key)
+            outcome = "hit"
+            if result is None and self._disk is not None:
+                result = await self._disk.get(key)
+                outcome = "disk_hit"
+                if result is not None:
+                    self._put_memory(key, result)
+
+            if result is not None:
+                request.future.set_result(result)
+            elif key in self._inflight:
+                self._inflight[key].followers.append(request)
+                outcome = "coalesced"
+            else:
+                self._lead(key, request, queue, [])
+                outcome = "miss"
+
+        cache_requests.inc(labels=(route, outcome))
+        if counts is not None:
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+        if outcome in ("bypass", "miss"):
+            return False
+        # Served or attached: it is no longer waiting in a gateway queue
+        request.dispatched_at = time.monotonic()
+        return True
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DISK_PATH) if RESPONSE_CACHE_ENABLED else None
+
+
+async def resolve(request: VLLMRequest, queue: asyncio.Queue, route: str, counts: Optional[Dict[str, int]] = None) -> bool:
+    """`ResponseCache.resolve` on the configured cache; always False when caching is disabled."""
+    if response_cache is None:
+        return False
+    return await response_cache.resolve(request, queue, route, counts)
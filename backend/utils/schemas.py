@@ -27,6 +27,10 @@ class FileObject(BaseModel):
     created_at: int
     filename: str
     purpose: str
+    # Computed while an upload is written; the per-line byte offsets live in a sidecar index
+    line_count: Optional[int] = None
+    invalid_lines: Optional[int] = None
+    checksum: Optional[str] = None
 
 class BatchRequestCounts(BaseModel):
     total: int = 0
@@ -54,6 +58,10 @@ class Batch(BaseModel):
     cancelled_at: Optional[int] = None
     request_counts: BatchRequestCounts = Field(default_factory=BatchRequestCounts)
     usage: Optional[Dict[str, int]] = Field(default_factory=lambda: {"prompt_tokens": 0, "completion_tokens": 0})
+    response_cache: Optional[Dict[str, int]] = None
+    # Gateway extension, kept out of `usage` so that stays the same shape as OpenAI's
+    estimated_cached_prefix_tokens: Optional[int] = None
+    api_key_id: Optional[str] = None
     metadata: Optional[Dict[str, str]] = None
 
 class BatchCreate(BaseModel):
@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import sqlite3
+from typing import Dict, Optional, Tuple
+
+from .config import METADATA_DB_PATH
+from .schemas import Batch, FileObject
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataStore:
+    """
+    Durable record of `FileObject`s, `Batch`es and the working files each batch writes to.
+
+    The in-memory `files_db`/`batches_db` dicts remain the source for reads; this store is
+    written through on every change so that state survives a gateway restart.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            " id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " output_file_id TEXT,"
+            " error_file_id TEXT)"
+        )
+
+    def save_file(self, file_object: FileObject):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO files (id, data) VALUES (?, ?)",
+            (file_object.id, file_object.model_dump_json()),
+        )
+
+    def save_batch(self, batch: Batch, output_file_id: Optional[str] = None, error_file_id: Optional[str] = None):
+        """Saves a batch. The working file ids are only updated when given."""
+        self._conn.execute(
+            "INSERT INTO batches (id, data, output_file_id, error_file_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET data = excluded.data, "
+            "output_file_id = COALESCE(excluded.output_file_id, batches.output_file_id), "
+            "error_file_id = COALESCE(excluded.error_file_id, batches.error_file_id)",
+            (batch.id, batch.model_dump_json(), output_file_id, error_file_id),
+        )
+
+    def working_files(self, batch_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """Returns the (output, error) file ids a batch is writing to, if it has started."""
+        row = self._conn.execute(
+            "SELECT output_file_id, error_file_id FROM batches WHERE id = ?", (batch_id,)
+        ).fetchone()
+        return (row[0], row[1]) if row else (None, None)
+
+    def load_files(self) -> Dict[str, FileObject]:
+        rows = self._conn.execute("SELECT data FROM files").fetchall()
+        return {obj.id: obj for obj in (FileObject(**json.loads(row[0])) for row in rows)}
+
+    def load_batches(self) -> Dict[str, Batch]:
+        rows = self._conn.execute("SELECT data FROM batches").fetchall()
+        return {obj.id: obj for obj in (Batch(**json.loads(row[0])) for row in rows)}
+
+    def close(self):
+        self._conn.close()
+
+
+store = MetadataStore(METADATA_DB_PATH)
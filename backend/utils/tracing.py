@@ -0,0 +1,119 @@
+import collections
+import json
+import logging
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .config import SLOW_REQUEST_THRESHOLD, PROFILER_SAMPLE_INTERVAL, TRACE_DUMP_PATH
+
+logger = logging.getLogger(__name__)
+# Slow-request traces go to their own logger so they can be routed to a file
+trace_logger = logging.getLogger("gateway.slow_requests")
+
+# Each stage is the time between two lifecycle marks; marks a request never reached are skipped
+STAGES: Tuple[Tuple[str, str, str], ...] = (
+    ("truncate", "received", "truncated"),
+    ("assembly", "created", "enqueued"),
+    ("queue", "enqueued", "dispatched"),
+    ("upstream", "dispatched", "upstream_done"),
+    ("serialize", "upstream_done", "responded"),
+)
+# Frames kept per profiler sample, innermost last
+PROFILER_STACK_DEPTH = 24
+# Seconds of samples kept; traces can only cover requests shorter than this
+PROFILER_HISTORY = 300.0
+PROFILER_TOP_STACKS = 20
+
+
+def lifecycle_marks(request) -> Dict[str, float]:
+    """Collects the monotonic timestamps a `VLLMRequest` has recorded so far."""
+    marks = dict(request.timings)
+    marks["created"] = request.created_at
+    marks["enqueued"] = request.enqueued_at
+    if request.dispatched_at is not None:
+        marks["dispatched"] = request.dispatched_at
+    return marks
+
+
+def stage_durations(request) -> Dict[str, float]:
+    """Returns the duration of each lifecycle stage the request went through, in milliseconds."""
+    marks = lifecycle_marks(request)
+    durations = {}
+    for stage, start, end in STAGES:
+        if start in marks and end in marks:
+            durations[stage] = round((marks[end] - marks[start]) * 1000, 3)
+    start = marks.get("received", marks["created"])
+    end = max(marks.values())
+    durations["total"] = round((end - start) * 1000, 3)
+    return durations
+
+
+def server_timing(request) -> str:
+    """Formats a request's stage durations as a Server-Timing header value."""
+    return ", ".join(f"{stage};dur={duration}" for stage, duration in stage_durations(request).items())
+
+
+class _StackSampler:
+    """
+    Samples the event loop thread's stack every `interval` seconds from a daemon thread, keeping
+    a bounded history. Slow requests are attributed the samples taken during their lifetime,
+    which shows where the gateway itself spent the time without attaching a debugger.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._target_thread_id = threading.get_ident()
+        self._samples = collections.deque(maxlen=max(1, int(PROFILER_HISTORY / interval)))
+        self._thread = threading.Thread(target=self._run, name="gateway-stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        logger.info(f"Stack sampler started (every {self.interval * 1000:.0f}ms).")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self._target_thread_id)
+            stack = []
+            while frame is not None and len(stack) < PROFILER_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self._samples.append((time.monotonic(), ";".join(reversed(stack))))
+
+    def stacks_between(self, start: float, end: float) -> List[Tuple[str, int]]:
+        """Returns the most frequent collapsed stacks sampled in [start, end]."""
+        counts = collections.Counter(stack for at, stack in list(self._samples) if start <= at <= end)
+        return counts.most_common(PROFILER_TOP_STACKS)
+
+
+_sampler: Optional[_StackSampler] = None
+
+
+def start_tracing():
+    """Starts the optional stack sampler on the calling (event loop) thread and sets up trace output."""
+    global _sampler
+    if TRACE_DUMP_PATH and not trace_logger.handlers:
+        handler = logging.FileHandler(TRACE_DUMP_PATH)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_logger.addHandler(handler)
+        trace_logger.propagate = False
+    if PROFILER_SAMPLE_INTERVAL > 0 and _sampler is None:
+        _sampler = _StackSampler(PROFILER_SAMPLE_INTERVAL)
+        _sampler.start()
+
+
+def record_trace(request, route: str):
+    """Dumps the request's lifecycle, plus profiler samples if enabled, when it was slow."""
+    if SLOW_REQUEST_THRESHOLD <= 0:
+        return
+    durations = stage_durations(request)
+    if durations["total"] < SLOW_REQUEST_THRESHOLD * 1000:
+        return
+    trace = {"route": route, "custom_id": request.custom_id, "stages_ms": durations}
+    if _sampler is not None:
+        marks = lifecycle_marks(request)
+        trace["stacks"] = _sampler.stacks_between(marks.get("received", marks["created"]), max(marks.values()))
+    trace_logger.warning(json.dumps(trace))
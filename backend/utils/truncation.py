@@ -1,7 +1,183 @@
-from transformers import AutoTokenizer
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from .config import TOKENIZER_NAME, TOKENIZER_PATH, TOKENIZER_OFFLINE
+from .metrics import Counter, Gauge
+from .vllm_queue import collect_batch
+
+logger = logging.getLogger(__name__)
 
 MAX_INPUT_LENGTH = 4096
-tokenizer = AutoTokenizer.from_pretrained("Qwen/Qwen3-4b-FP8")
+# Tokens the chat template adds around messages (role markers, separators, assistant prefix)
+CHAT_TEMPLATE_OVERHEAD = 16
+# Upper bound on special tokens added per encode call, assumed until the tokenizer has loaded
+DEFAULT_SPECIAL_TOKENS_PER_TEXT = 4
+
+# Tokenization runs on these threads; the fast tokenizer releases the GIL while encoding a batch
+TOKENIZER_THREADS = 4
+# Maximum number of texts coalesced into a single tokenizer call
+TOKENIZER_MAX_BATCH = 256
+
+# Number of distinct message contents whose token count is remembered
+TOKEN_COUNT_CACHE_SIZE = 65536
+# Tokens by which counting a template prefix and the rest of a message separately may be off
+# from counting them together, as merges across the join are missed
+PREFIX_JOIN_SLACK = 2
+
+_tokenizer_executor = ThreadPoolExecutor(max_workers=TOKENIZER_THREADS, thread_name_prefix="tokenizer")
+_tokenizer = None
+_special_tokens_per_text = DEFAULT_SPECIAL_TOKENS_PER_TEXT
+_tokenizer_lock = threading.Lock()
+_tokenizer_future: Optional[concurrent.futures.Future] = None
+_encode_queue: asyncio.Queue = None
+_encode_workers = []
+
+
+token_count_lookups = Counter(
+    "gateway_token_count_lookups_total",
+    "Token counts resolved without encoding (fast_path, cache_hit) or by encoding (cache_miss).",
+    labelnames=("result",),
+)
+truncated_requests = Counter(
+    "gateway_truncated_requests_total",
+    "Requests whose prompt was truncated to fit the context window.",
+    labelnames=("route",),
+)
+startup_seconds = Gauge(
+    "gateway_startup_seconds",
+    "Seconds from the start of the gateway import until each component was ready.",
+    labelnames=("component",),
+)
+tokenize_seconds_saved = Counter(
+    "gateway_tokenize_seconds_saved_total",
+    "Estimated tokenizer time avoided by the fast path and the token-count cache.",
+)
+
+# Running mean of tokenizer time per text, used to estimate the time saved
+_encode_seconds_per_text = 0.0
+
+
+@dataclass
+class _EncodeJob:
+    text: str
+    future: asyncio.Future = field(default_factory=asyncio.Future)
+
+
+class _SerializedTokenizer:
+    """The subset of the transformers tokenizer API used here, backed by a bare tokenizer.json."""
+
+    def __init__(self, path: str):
+        from tokenizers import Tokenizer
+        self._tokenizer = Tokenizer.from_file(path)
+
+    def __call__(self, texts: List[str]) -> Dict[str, List[List[int]]]:
+        return {"input_ids": [encoding.ids for encoding in self._tokenizer.encode_batch(texts)]}
+
+    def encode(self, text: str) -> List[int]:
+        return self._tokenizer.encode(text).ids
+
+    def decode(self, token_ids: List[int]) -> str:
+        return self._tokenizer.decode(token_ids, skip_special_tokens=False)
+
+    def num_special_tokens_to_add(self) -> int:
+        return len(self._tokenizer.encode("").ids)
+
+
+def _load_tokenizer():
+    source = TOKENIZER_PATH or TOKENIZER_NAME
+    if source.endswith(".json"):
+        # Skips the transformers import entirely
+        return _SerializedTokenizer(source)
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(source, local_files_only=TOKENIZER_OFFLINE)
+
+
+def get_tokenizer():
+    """Returns the tokenizer, loading it on the calling thread if the background load has not finished."""
+    global _tokenizer, _special_tokens_per_text
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                start = time.monotonic()
+                loaded = _load_tokenizer()
+                _special_tokens_per_text = loaded.num_special_tokens_to_add()
+                _tokenizer = loaded
+                logger.info(f"Tokenizer loaded from {TOKENIZER_PATH or TOKENIZER_NAME} in {time.monotonic() - start:.2f}s.")
+    return _tokenizer
+
+
+def start_tokenizer_loading(started_at: Optional[float] = None) -> concurrent.futures.Future:
+    """
+    Loads the tokenizer in the background. `started_at` is a time.monotonic() reference
+    (e.g. the start of the app import) against which the ready time is reported.
+    """
+    global _tokenizer_future
+    if _tokenizer_future is None:
+        def _load():
+            tok = get_tokenizer()
+            if started_at is not None:
+                elapsed = time.monotonic() - started_at
+                startup_seconds.set(elapsed, labels=("tokenizer",))
+                logger.info(f"Tokenizer ready {elapsed:.2f}s after gateway import started.")
+            return tok
+        _tokenizer_future = _tokenizer_executor.submit(_load)
+        _tokenizer_future.add_done_callback(_log_load_failure)
+    return _tokenizer_future
+
+
+def _log_load_failure(future: concurrent.futures.Future):
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Tokenizer failed to load from {TOKENIZER_PATH or TOKENIZER_NAME}: {error!r}. Requests that need truncation will fail.")
+
+
+def tokenizer_status() -> Dict[str, object]:
+    """Reports whether the tokenizer is loaded and, if its background load failed, why."""
+    error = None
+    if _tokenizer_future is not None and _tokenizer_future.done() and _tokenizer is None:
+        error = repr(_tokenizer_future.exception())
+    return {"source": TOKENIZER_PATH or TOKENIZER_NAME, "loaded": _tokenizer is not None, "error": error}
+
+
+async def wait_for_tokenizer():
+    """Waits for the background tokenizer load without blocking the event loop."""
+    if _tokenizer is None:
+        await asyncio.wrap_future(start_tokenizer_loading())
+    return _tokenizer
+
+
+class TokenCountCache:
+    """A bounded LRU of token counts keyed by a hash of the message content."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+
+    def get(self, key: bytes) -> Optional[int]:
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+        return count
+
+    def put(self, key: bytes, count: int):
+        self._counts[key] = count
+        self._counts.move_to_end(key)
+        if len(self._counts) > self.capacity:
+            self._counts.popitem(last=False)
+
+    def __len__(self):
+        return len(self._counts)
+
+
+token_count_cache = TokenCountCache(TOKEN_COUNT_CACHE_SIZE)
 
 def _get_message_content(message) -> str:
     """Safely extract content from either a dict-style or object-style message."""
@@ -18,30 +194,166 @@ def _set_message_content(message, new_content: str) -> None:
     elif isinstance(message, dict):
         message["content"] = new_content
 
-def truncate_messages(messages: list, max_length: int) -> list:
-    """Truncates messages to a maximum token length, optimizing for performance.
+def _encode_batch(texts: List[str]) -> List[List[int]]:
+    global _encode_seconds_per_text
+    start = time.perf_counter()
+    token_ids = get_tokenizer()(texts)["input_ids"]
+    per_text = (time.perf_counter() - start) / max(len(texts), 1)
+    _encode_seconds_per_text += 0.05 * (per_text - _encode_seconds_per_text)
+    return token_ids
 
-    Works with both dict messages ({"role": str, "content": str}) and
-    object messages that expose a `.content` attribute (e.g., Pydantic models).
-    Only the last message is truncated to fit the limit.
+def _fits_without_tokenizing(contents: List[str], max_length: int) -> bool:
+    """
+    Byte-level BPE never produces more tokens than the text has UTF-8 bytes, plus whatever
+    special tokens the tokenizer adds per call. If that bound fits, no count is needed, and
+    the tokenizer does not even have to be loaded yet.
     """
+    special_per_text = _special_tokens_per_text
+    bound = 0
+    for content in contents:
+        # A character is at most 4 UTF-8 bytes; only measure exactly when that is inconclusive
+        bound += len(content) * 4 if len(content) * 4 <= max_length else len(content.encode("utf-8"))
+        bound += special_per_text
+        if bound > max_length:
+            return False
+    return True
 
-    total_tokens = 0
-    for msg in messages:
-        content = _get_message_content(msg)
-        total_tokens += len(tokenizer.encode(content))
+def _content_key(content: str) -> bytes:
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
 
-    if total_tokens > max_length and messages:
-        excess_tokens = total_tokens - max_length
+def _record_saved(count: int, result: str):
+    token_count_lookups.inc(count, labels=(result,))
+    tokenize_seconds_saved.inc(count * _encode_seconds_per_text)
+
+def _cached_counts(contents: List[str]):
+    """Returns (keys, counts) with None in `counts` for contents that still need encoding."""
+    keys = [_content_key(content) for content in contents]
+    counts = [token_count_cache.get(key) for key in keys]
+    hits = sum(count is not None for count in counts)
+    if hits:
+        _record_saved(hits, "cache_hit")
+    if hits < len(counts):
+        token_count_lookups.inc(len(counts) - hits, labels=("cache_miss",))
+    return keys, counts
+
+def _byte_bound(content: str) -> int:
+    """Upper bound on the tokens of `content` alone, excluding special tokens."""
+    return len(content.encode("utf-8"))
+
+async def _fits_with_prefix(content: str, prefix: str, prefix_key: bytes, max_length: int) -> bool:
+    """
+    Checks a message that starts with a shared template prefix against `max_length`. The
+    prefix's count comes from the cache (encoded once per template), so only the per-line
+    remainder is bounded by its bytes or, failing that, tokenized.
+    """
+    prefix_count = token_count_cache.get(prefix_key)
+    if prefix_count is None:
+        token_count_lookups.inc(labels=("cache_miss",))
+        prefix_count = len((await encode_texts([prefix]))[0])
+        token_count_cache.put(prefix_key, prefix_count)
+    else:
+        _record_saved(1, "cache_hit")
 
-        last_content = _get_message_content(messages[-1])
-        last_tokens = tokenizer.encode(last_content)
+    remainder = content[len(prefix):]
+    if prefix_count + _byte_bound(remainder) <= max_length:
+        return True
+    remainder_count = len((await encode_texts([remainder]))[0]) - _special_tokens_per_text
+    return prefix_count + remainder_count + PREFIX_JOIN_SLACK <= max_length
 
-        if excess_tokens >= len(last_tokens):
-            truncated_tokens = []
-        else:
-            truncated_tokens = last_tokens[:-excess_tokens]
+def _truncated_tokens(last_tokens: List[int], total_tokens: int, max_length: int) -> List[int]:
+    excess_tokens = total_tokens - max_length
+    if excess_tokens >= len(last_tokens):
+        return []
+    return last_tokens[:-excess_tokens]
 
-        _set_message_content(messages[-1], tokenizer.decode(truncated_tokens))
+async def _encode_worker():
+    """Drains whatever encode jobs are waiting and tokenizes them with one batched call."""
+    loop = asyncio.get_running_loop()
+    while True:
+        jobs = [job for job in await collect_batch(_encode_queue, TOKENIZER_MAX_BATCH, 0) if not job.future.done()]
+        if not jobs:
+            continue
+        try:
+            token_ids = await loop.run_in_executor(_tokenizer_executor, _encode_batch, [job.text for job in jobs])
+        except Exception as e:
+            for job in jobs:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            continue
+        for job, ids in zip(jobs, token_ids):
+            if not job.future.done():
+                job.future.set_result(ids)
+
+def _ensure_encode_workers():
+    global _encode_queue
+    if _encode_workers:
+        return
+    _encode_queue = asyncio.Queue()
+    # One worker per thread: while all threads are busy, new jobs pile up into a bigger next batch
+    for _ in range(TOKENIZER_THREADS):
+        _encode_workers.append(asyncio.create_task(_encode_worker()))
+
+async def encode_texts(texts: List[str]) -> List[List[int]]:
+    """
+    Tokenizes `texts` on the tokenizer thread pool without blocking the event loop.
+    Texts submitted concurrently by different requests are coalesced into batched calls.
+    """
+    await wait_for_tokenizer()
+    _ensure_encode_workers()
+    jobs = [_EncodeJob(text) for text in texts]
+    for job in jobs:
+        _encode_queue.put_nowait(job)
+    return list(await asyncio.gather(*(job.future for job in jobs)))
+
+def prompt_token_budget(max_tokens: int, max_length: int = MAX_INPUT_LENGTH) -> int:
+    """Returns how many message tokens fit in the context window alongside `max_tokens` of generation."""
+    return max(max_length - (max_tokens or 0) - CHAT_TEMPLATE_OVERHEAD, 0)
+
+async def truncate_messages_async(
+    messages: list,
+    max_length: int,
+    prefix: Optional[str] = None,
+    prefix_key: Optional[bytes] = None,
+) -> list:
+    """
+    Truncates messages to a maximum token length, tokenizing on the tokenizer pool so the event
+    loop never blocks.
+
+    Works with both dict messages ({"role": str, "content": str}) and
+    object messages that expose a `.content` attribute (e.g., Pydantic models).
+    Only the last message is truncated to fit the limit. Prompts that provably fit are
+    not tokenized at all, and token counts of previously seen contents come from a cache.
+
+    A single message rendered from a template can pass the template's `prefix` and a stable
+    `prefix_key` for it: the prefix's count is then cached and shared by every such message.
+    """
+    contents = [_get_message_content(msg) for msg in messages]
+    if _fits_without_tokenizing(contents, max_length):
+        _record_saved(len(contents), "fast_path")
+        return messages
+
+    if prefix and prefix_key is not None and len(contents) == 1 and contents[0].startswith(prefix):
+        if await _fits_with_prefix(contents[0], prefix, prefix_key, max_length):
+            return messages
+
+    keys, counts = _cached_counts(contents)
+    missing = [i for i, count in enumerate(counts) if count is None]
+    encoded: Dict[int, List[int]] = {}
+    if missing:
+        for i, ids in zip(missing, await encode_texts([contents[i] for i in missing])):
+            encoded[i] = ids
+            counts[i] = len(ids)
+            token_count_cache.put(keys[i], counts[i])
+
+    total_tokens = sum(counts)
+    if total_tokens > max_length and messages:
+        last = len(messages) - 1
+        # Reuse the ids computed above; only a cached last message needs encoding again
+        last_tokens = encoded[last] if last in encoded else (await encode_texts([contents[last]]))[0]
+        loop = asyncio.get_running_loop()
+        truncated_content = await loop.run_in_executor(
+            _tokenizer_executor, _tokenizer.decode, _truncated_tokens(last_tokens, total_tokens, max_length)
+        )
+        _set_message_content(messages[-1], truncated_content)
 
     return messages
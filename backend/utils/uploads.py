@@ -0,0 +1,148 @@
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Optional
+
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from .file_index import FileIndexStats, IndexedFileWriter
+
+# Form fields other than the file (e.g. `purpose`) are short; anything bigger is rejected
+MAX_FIELD_SIZE = 64 * 1024
+
+
+class UploadError(ValueError):
+    """The request body is not a usable multipart upload."""
+
+
+@dataclass
+class Upload:
+    fields: Dict[str, str]
+    filename: str
+    stats: FileIndexStats
+
+
+class _PartCollector:
+    """
+    MultipartParser callbacks. Small fields are kept in `fields`; bytes of the file part are
+    appended to `file_data` for the caller to write out between parser calls.
+    """
+
+    def __init__(self, file_field: str):
+        self.file_field = file_field
+        self.fields: Dict[str, str] = {}
+        self.filename: Optional[str] = None
+        self.file_data = bytearray()
+        # Set once the closing boundary has been parsed
+        self.complete = False
+        self._header_name = bytearray()
+        self._header_value = bytearray()
+        self._disposition = b""
+        self._name = ""
+        # The value of the current field part, or None while inside the file part
+        self._value: Optional[bytearray] = None
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_end": self.on_end,
+        }
+
+    def on_part_begin(self):
+        self._disposition = b""
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = bytes(self._header_value)
+        self._header_name.clear()
+        self._header_value.clear()
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise UploadError('Every form part needs a Content-Disposition header with a "name".')
+        self._name = options[b"name"].decode("utf-8", errors="replace")
+        if self._name == self.file_field and b"filename" in options:
+            if self.filename is not None:
+                raise UploadError(f"Only one '{self.file_field}' may be uploaded.")
+            self.filename = options[b"filename"].decode("utf-8", errors="replace")
+            self._value = None
+        else:
+            self._value = bytearray()
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._value is None:
+            self.file_data += data[start:end]
+            return
+        if len(self._value) + end - start > MAX_FIELD_SIZE:
+            raise UploadError(f"Form field '{self._name}' is larger than {MAX_FIELD_SIZE} bytes.")
+        self._value += data[start:end]
+
+    def on_part_end(self):
+        if self._value is not None:
+            self.fields[self._name] = self._value.decode("utf-8", errors="replace")
+        self._value = None
+
+    def on_end(self):
+        self.complete = True
+
+
+async def receive_upload(
+    content_type: str,
+    stream: AsyncIterator[bytes],
+    file_field: str,
+    file_path: str,
+    chunk_size: int,
+) -> Upload:
+    """
+    Parses a multipart/form-data body as it arrives and writes its `file_field` part straight
+    to `file_path`, indexing it on the way (see `IndexedFileWriter`), so the upload is never
+    spooled to a temporary file first. Writes go to a worker thread in `chunk_size` pieces.
+
+    Raises UploadError if the body is not multipart or has no `file_field` file. On any
+    failure, including the client going away, the partial file and its index are removed.
+    """
+    media_type, params = parse_options_header(content_type)
+    boundary = params.get(b"boundary")
+    if media_type != b"multipart/form-data" or not boundary:
+        raise UploadError("Expected a multipart/form-data body.")
+
+    collector = _PartCollector(file_field)
+    parser = MultipartParser(boundary, collector.callbacks())
+    writer = await asyncio.to_thread(IndexedFileWriter, file_path)
+    try:
+        async for chunk in stream:
+            try:
+                parser.write(chunk)
+            except MultipartParseError as e:
+                raise UploadError(f"Malformed multipart body: {e}") from e
+            if len(collector.file_data) >= chunk_size:
+                data = bytes(collector.file_data)
+                collector.file_data.clear()
+                await asyncio.to_thread(writer.write, data)
+        parser.finalize()
+        if not collector.complete:
+            raise UploadError("The upload ended before its closing boundary.")
+        if collector.filename is None:
+            raise UploadError(f"The upload has no '{file_field}' part.")
+        if collector.file_data:
+            await asyncio.to_thread(writer.write, bytes(collector.file_data))
+        stats = await asyncio.to_thread(writer.finish)
+    except BaseException:
+        # Just closes and unlinks, so it runs inline and still happens when the request is cancelled
+        writer.abort()
+        raise
+
+    return Upload(fields=collector.fields, filename=collector.filename, stats=stats)
@@ -1,11 +1,17 @@
 import asyncio
 from dataclasses import dataclass, field
 import time
-from typing import Any, List, Dict
-import aiohttp
+from typing import Any, Callable, List, Dict, Optional, Tuple
 import logging
 
-from .config import VLLM_URL
+import aiohttp
+
+from .config import UPSTREAM_TIMEOUT, UPSTREAM_PASSTHROUGH
+from .http_client import get_http_client
+from .backends import backend_pool, routing_key, estimate_tokens
+from .metrics import Counter, Gauge, Histogram, add_collect_hook
+from .fair_queue import FairQueue, DEFAULT_FLOW
+from .passthrough import from_upstream, body_usage
 
 
 @dataclass
@@ -15,77 +21,401 @@ class VLLMRequest:
     future: asyncio.Future = field(default_factory=asyncio.Future)
     vllm_endpoint: str = "/v1/chat/completions"
     custom_id: str = None
+    # Monotonic lifecycle timestamps; enqueued_at is reset when the request actually enters a queue
+    created_at: float = field(default_factory=time.monotonic)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    dispatched_at: Optional[float] = None
+    # Other lifecycle marks by name ("received", "truncated", "upstream_done", "responded", ...)
+    timings: Dict[str, float] = field(default_factory=dict)
+    # (tenant, flow id) and share used by the fair batch scheduler
+    flow: Tuple[str, str] = DEFAULT_FLOW
+    weight: float = 1.0
+    # Requests with the same key prefer the same backend; derived from the prompt if unset
+    routing_key: Optional[str] = None
+    # Set for streaming requests: the future resolves with the open upstream response, and the
+    # dispatch slot is held until the route sets this event after relaying the stream
+    stream_done: Optional[asyncio.Event] = None
+
+    def mark(self, stage: str, at: Optional[float] = None):
+        """Records the time the request reached a lifecycle stage."""
+        self.timings[stage] = time.monotonic() if at is None else at
 
 interactive_queue = asyncio.Queue()
-batch_queue = asyncio.Queue()
+# Batches are served by weighted deficit round-robin across API keys and batches, not FIFO
+batch_queue = FairQueue()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+queue_wait_seconds = Histogram(
+    "gateway_queue_wait_seconds",
+    "Time a request spent in a gateway queue before being dispatched upstream.",
+    labelnames=("queue",),
+)
+micro_batch_size = Histogram(
+    "gateway_micro_batch_size",
+    "Number of requests collected into a single micro-batch.",
+    labelnames=("queue",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+inflight_requests = Gauge(
+    "gateway_inflight_requests",
+    "Requests currently awaiting an upstream response.",
+    labelnames=("queue",),
+)
+slot_occupancy_ratio = Histogram(
+    "gateway_slot_occupancy_ratio",
+    "Time-weighted fraction of dispatch slots in use, one observation per occupancy window.",
+    labelnames=("queue",),
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0),
+)
+queue_depth = Gauge(
+    "gateway_queue_depth",
+    "Requests waiting in a gateway queue, read at scrape time.",
+    labelnames=("queue",),
+)
+upstream_latency_seconds = Histogram(
+    "gateway_upstream_latency_seconds",
+    "Time from dispatch to a complete upstream response, for non-streaming requests.",
+    labelnames=("queue",),
+)
+usage_tokens = Counter(
+    "gateway_usage_tokens_total",
+    "Tokens reported in upstream `usage`; rate() of this gives tokens/s.",
+    labelnames=("queue", "kind"),
+)
+last_window_occupancy = Gauge(
+    "gateway_slot_occupancy_last_window",
+    "Time-weighted fraction of dispatch slots in use during the most recent occupancy window.",
+    labelnames=("queue",),
+)
 
-async def vllm_consumer(worker_id: int, queue: asyncio.Queue, batch_size: int, wait_time: float):
+# Strong references to fire-and-forget dispatch tasks so they are not garbage collected.
+_background_tasks = set()
+
+# Called as listener(queue_name, request, upstream_seconds) after each upstream call resolves.
+_completion_listeners: List[Callable[[str, "VLLMRequest", float], None]] = []
+
+
+def add_completion_listener(listener: Callable[[str, "VLLMRequest", float], None]):
+    """Registers a callback that is told about every completed upstream call."""
+    _completion_listeners.append(listener)
+
+
+def _record_completion(name: str, request: "VLLMRequest", upstream_seconds: float):
+    """Records a finished non-streaming upstream call and tells the completion listeners."""
+    labels = (name,)
+    upstream_latency_seconds.observe(upstream_seconds, labels)
+    result = request.future.result() if request.future.done() and not request.future.cancelled() else None
+    usage = body_usage(result.get("body")) if result else None
+    if usage is not None:
+        usage_tokens.inc(usage.get("prompt_tokens") or 0, (name, "prompt"))
+        usage_tokens.inc(usage.get("completion_tokens") or 0, (name, "completion"))
+
+    for listener in _completion_listeners:
+        try:
+            listener(name, request, upstream_seconds)
+        except Exception as e:
+            logger.error(f"Completion listener {listener} failed: {e}")
+
+
+class ConcurrencyLimit:
     """
-    A consumer that pulls requests from a given queue, batches them, and sends them to vLLM.
+    A semaphore whose capacity can be changed while permits are held. Lowering the limit
+    never interrupts running requests; new ones wait until enough of them have finished.
+    `saturated` is set whenever an acquire had to wait and is cleared by whoever reads it.
     """
-    logger.info(f"vLLM consumer worker-{worker_id} started for queue: {queue.__class__.__name__}.")
-    while True:
-        requests_batch: List[VLLMRequest] = []
-        
-        start_time = time.time()
-        while time.time() - start_time < wait_time and len(requests_batch) < batch_size:
-            try:
-                request = queue.get_nowait()
-                requests_batch.append(request)
-                queue.task_done()
-            except asyncio.QueueEmpty:
-                await asyncio.sleep(0.01)
-                if not requests_batch:  # If no requests were in the batch, break inner loop to avoid waiting
-                    break
-        
-        if not requests_batch:
-            await asyncio.sleep(0.01)
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.saturated = False
+        self._available = asyncio.Event()
+        self._available.set()
+
+    async def acquire(self):
+        while self.in_use >= self.limit:
+            self.saturated = True
+            self._available.clear()
+            await self._available.wait()
+        self.in_use += 1
+
+    def release(self):
+        self.in_use -= 1
+        if self.in_use < self.limit:
+            self._available.set()
+
+    def set_limit(self, limit: int):
+        self.limit = limit
+        if self.in_use < self.limit:
+            self._available.set()
+
+
+class SlotOccupancy:
+    """
+    Tracks how many of a dispatcher's slots are busy and reports the time-weighted occupancy
+    once per `window` seconds. Windows are closed lazily on the next acquire/release.
+    """
+
+    def __init__(self, name: str, slots: int, window: float):
+        self.labels = (name,)
+        self.slots = slots
+        self.window = window
+        self.in_use = 0
+        now = time.monotonic()
+        self._window_start = now
+        self._last_change = now
+        self._busy_area = 0.0
+
+    def _advance(self):
+        now = time.monotonic()
+        self._busy_area += self.in_use * (now - self._last_change)
+        self._last_change = now
+        elapsed = now - self._window_start
+        if elapsed >= self.window:
+            ratio = self._busy_area / (self.slots * elapsed)
+            slot_occupancy_ratio.observe(ratio, self.labels)
+            last_window_occupancy.set(ratio, self.labels)
+            logger.info(f"Dispatcher {self.labels[0]}: slot occupancy {ratio:.1%} over the last {elapsed:.1f}s ({self.slots} slots).")
+            self._window_start = now
+            self._busy_area = 0.0
+
+    def acquire(self):
+        self._advance()
+        self.in_use += 1
+        inflight_requests.inc(1, self.labels)
+
+    def release(self):
+        self._advance()
+        self.in_use -= 1
+        inflight_requests.dec(1, self.labels)
+
+
+def _collect_queue_depths():
+    queue_depth.set(interactive_queue.qsize(), ("interactive",))
+    queue_depth.set(batch_queue.qsize(), ("batch",))
+
+
+add_collect_hook(_collect_queue_depths)
+
+
+def queue_name(queue: asyncio.Queue) -> str:
+    """Returns the label used for a gateway queue in logs and metrics."""
+    if queue is interactive_queue:
+        return "interactive"
+    if queue is batch_queue:
+        return "batch"
+    return queue.__class__.__name__
+
+
+async def collect_batch(queue: asyncio.Queue, batch_size: int, wait_time: float) -> List[Any]:
+    """
+    Blocks until at least one item is available, then keeps collecting until the batch holds
+    `batch_size` items or `wait_time` seconds have passed since the first one arrived.
+    An idle queue costs no wakeups.
+    """
+    loop = asyncio.get_running_loop()
+    requests_batch: List[Any] = [await queue.get()]
+    queue.task_done()
+    deadline = loop.time() + wait_time
+
+    while len(requests_batch) < batch_size:
+        try:
+            requests_batch.append(queue.get_nowait())
+            queue.task_done()
             continue
+        except asyncio.QueueEmpty:
+            pass
 
-        logger.info(f"Worker-{worker_id}: Processing batch of {len(requests_batch)} requests.")
-        endpoint = requests_batch[0].vllm_endpoint
-        vllm_full_url = f"{VLLM_URL}{endpoint}"
-
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for req in requests_batch:
-                task = session.post(vllm_full_url, json=req.request_body, timeout=180)
-                tasks.append(task)
-            
-            responses = await asyncio.gather(*tasks, return_exceptions=True)
-
-        for request, response in zip(requests_batch, responses):
-            try:
-                if isinstance(response, Exception):
-                    logger.error(f"Worker-{worker_id}: Request {request.custom_id} failed with exception: {response}")
-                    result = {
-                        "status_code": 500,
-                        "body": {"error": str(response)}
-                    }
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            requests_batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+            queue.task_done()
+        except asyncio.TimeoutError:
+            break
+
+    return requests_batch
+
+
+async def _dispatch_stream(request: VLLMRequest, worker_id: int, key: Optional[str], tokens: int):
+    """
+    Opens a streaming request and resolves its future with {"status_code": 200, "response"}, or
+    with {"status_code", "body"} on an upstream error. Returns once the caller sets
+    `stream_done`, so the request keeps its dispatch slot for the stream's lifetime. Setting
+    `stream_done` early (client gone) abandons the upstream request even before it answers.
+    """
+    backend = backend_pool.pick(key)
+    backend_pool.acquire(backend, tokens)
+    connection_failed = False
+    opening = asyncio.ensure_future(
+        get_http_client().post(f"{backend.url}{request.vllm_endpoint}", json=request.request_body, timeout=UPSTREAM_TIMEOUT)
+    )
+    released = asyncio.ensure_future(request.stream_done.wait())
+    try:
+        # The upstream timeout bounds the stream as a whole, so never hold the slot longer
+        await asyncio.wait({opening, released}, timeout=UPSTREAM_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        if not opening.done():
+            opening.cancel()
+            return
+        response = opening.result()
+        try:
+            if response.status != 200:
+                logger.warning(f"Worker-{worker_id}: Stream {request.custom_id} received non-200 status: {response.status}")
+                result = {"status_code": response.status, "body": await response.text()}
+                if not request.future.done():
                     request.future.set_result(result)
-                else:
-                    response_body = await response.json()
+                return
+            if request.future.done():
+                return
+            request.mark("upstream_done")
+            request.future.set_result({"status_code": 200, "response": response})
+            await asyncio.wait({released}, timeout=UPSTREAM_TIMEOUT)
+            if not released.done():
+                logger.warning(f"Worker-{worker_id}: Stream {request.custom_id} was not released within {UPSTREAM_TIMEOUT}s.")
+        finally:
+            # Closing mid-stream drops the connection, which makes vLLM abort the generation
+            response.close()
+    except Exception as e:
+        logger.error(f"Worker-{worker_id}: Stream {request.custom_id} to {backend.url} failed with exception: {e}")
+        connection_failed = isinstance(e, aiohttp.ClientConnectionError)
+        if not request.future.done():
+            request.future.set_result({"status_code": 503 if connection_failed else 500, "body": str(e)})
+    finally:
+        released.cancel()
+        backend_pool.release(backend, tokens, connection_failed)
+
+
+async def dispatch_request(request: VLLMRequest, worker_id: int):
+    """
+    Sends a single request to vLLM and resolves its future with {"status_code", "body"}.
+    With UPSTREAM_PASSTHROUGH a successful body is a `RawJSON` rather than a decoded dict.
+    Requests whose caller has already given up (future done or cancelled) are skipped.
+    """
+    if request.future.done():
+        return
+    request.dispatched_at = time.monotonic()
+    key = request.routing_key or routing_key(request.request_body)
+    tokens = estimate_tokens(request.request_body)
+    if request.stream_done is not None:
+        await _dispatch_stream(request, worker_id, key, tokens)
+        return
+    backend = None
+
+    # A connection failure is retried once on another backend
+    for attempt in range(2):
+        backend = backend_pool.pick(key, exclude=backend)
+        backend_pool.acquire(backend, tokens)
+        connection_failed = False
+        try:
+            async with get_http_client().post(f"{backend.url}{request.vllm_endpoint}", json=request.request_body, timeout=UPSTREAM_TIMEOUT) as response:
+                try:
+                    if UPSTREAM_PASSTHROUGH and response.status == 200:
+                        response_body = from_upstream(await response.read())
+                    else:
+                        response_body = await response.json()
                     result = {
                         "status_code": response.status,
                         "body": response_body
                     }
                     if response.status != 200:
-                         logger.warning(f"Worker-{worker_id}: Request {request.custom_id} received non-200 status: {response.status}")
-                    
-                    request.future.set_result(result)
+                        logger.warning(f"Worker-{worker_id}: Request {request.custom_id} received non-200 status: {response.status}")
+                except Exception as e:
+                    logger.error(f"Worker-{worker_id}: Error processing response for request {request.custom_id}: {e}")
+                    result = {
+                        "status_code": 500,
+                        "body": {"error": f"Internal server error processing response: {e}"}
+                    }
+        except Exception as e:
+            logger.error(f"Worker-{worker_id}: Request {request.custom_id} to {backend.url} failed with exception: {e}")
+            connection_failed = isinstance(e, aiohttp.ClientConnectionError)
+            result = {
+                "status_code": 500,
+                "body": {"error": str(e)}
+            }
+        finally:
+            backend_pool.release(backend, tokens, connection_failed)
+        if not connection_failed or len(backend_pool.backends) == 1 or request.future.done():
+            break
 
-            except Exception as e:
-                logger.error(f"Worker-{worker_id}: Error processing response for request {request.custom_id}: {e}")
-                error_result = {
-                    "status_code": 500,
-                    "body": {"error": f"Internal server error processing response: {e}"}
-                }
-                if not request.future.done():
-                    request.future.set_result(error_result)
+    request.mark("upstream_done")
+    if not request.future.done():
+        request.future.set_result(result)
+
+
+async def vllm_consumer(worker_id: int, queue: asyncio.Queue, batch_size: int, wait_time: float):
+    """
+    A consumer that pulls requests from a given queue, batches them, and sends them to vLLM.
+    """
+    name = queue_name(queue)
+    logger.info(f"vLLM consumer worker-{worker_id} started for queue: {name}.")
+    while True:
+        requests_batch = await collect_batch(queue, batch_size, wait_time)
+
+        dispatched_at = time.monotonic()
+        labels = (name,)
+        for req in requests_batch:
+            queue_wait_seconds.observe(dispatched_at - req.enqueued_at, labels)
+        micro_batch_size.observe(len(requests_batch), labels)
+
+        logger.info(f"Worker-{worker_id}: Processing batch of {len(requests_batch)} requests.")
+        inflight_requests.inc(len(requests_batch), labels)
+        try:
+            await asyncio.gather(*(dispatch_request(req, worker_id) for req in requests_batch))
+        finally:
+            inflight_requests.dec(len(requests_batch), labels)
+        completed_at = time.monotonic()
+        for req in requests_batch:
+            if req.dispatched_at is not None and req.stream_done is None:
+                _record_completion(name, req, completed_at - req.dispatched_at)
+
+
+async def concurrent_dispatcher(
+    worker_id: int,
+    queue: asyncio.Queue,
+    max_concurrency: int,
+    occupancy_window: float = 10.0,
+    limit: Optional[ConcurrencyLimit] = None,
+):
+    """
+    Keeps up to `max_concurrency` requests in flight, starting a new one as soon as any
+    completes. Unlike `vllm_consumer`, no request ever waits for another one to finish.
+    When a `limit` is given, its current value is used instead, so it can be tuned at runtime.
+    """
+    name = queue_name(queue)
+    labels = (name,)
+    if limit is None:
+        limit = ConcurrencyLimit(max_concurrency)
+    occupancy = SlotOccupancy(name, limit.limit, occupancy_window)
+    logger.info(f"vLLM concurrent dispatcher worker-{worker_id} started for queue: {name} (max_concurrency={limit.limit}).")
+
+    async def _run(request: VLLMRequest):
+        try:
+            await dispatch_request(request, worker_id)
+        finally:
+            occupancy.release()
+            limit.release()
+        # A stream's duration is set by the client reading it, so it says little about upstream load
+        if request.dispatched_at is not None and request.stream_done is None:
+            _record_completion(name, request, time.monotonic() - request.dispatched_at)
+
+    while True:
+        await limit.acquire()
+        request = await queue.get()
+        queue.task_done()
+
+        if request.future.done():
+            # The caller timed out while the request was queued
+            limit.release()
+            continue
+
+        queue_wait_seconds.observe(time.monotonic() - request.enqueued_at, labels)
+        occupancy.slots = limit.limit
+        occupancy.acquire()
+        task = asyncio.create_task(_run(request))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
 
 
 def start_vllm_consumer(worker_id: int, queue: asyncio.Queue, batch_size: int, wait_time: float):
@@ -93,3 +423,16 @@ def start_vllm_consumer(worker_id: int, queue: asyncio.Queue, batch_size: int, w
     Starts the vLLM consumer as a background task for a specific queue.
     """
     asyncio.create_task(vllm_consumer(worker_id, queue, batch_size, wait_time))
+
+
+def start_concurrent_dispatcher(
+    worker_id: int,
+    queue: asyncio.Queue,
+    max_concurrency: int,
+    occupancy_window: float = 10.0,
+    limit: Optional[ConcurrencyLimit] = None,
+):
+    """
+    Starts the concurrency-bounded dispatcher as a background task for a specific queue.
+    """
+    asyncio.create_task(concurrent_dispatcher(worker_id, queue, max_concurrency, occupancy_window, limit))
@@ -0,0 +1,211 @@
+"""
+Multi-backend routing check against several simulated vLLM servers.
+
+Starts three tests/mock_vllm.py instances on free local ports and the gateway with all of them
+in VLLM_URLS, then checks that
+  1. requests are spread by outstanding load once one backend would exceed the sticky bound,
+  2. requests sharing a prompt prefix stick to one backend,
+  3. a killed backend is ejected without failing requests, and readmitted once it is back.
+Exits non-zero on the first failed check. Runs on any CPU machine.
+
+    python tests/backend_routing_check.py
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from gateway_benchmark import BACKEND_DIR, TESTS_DIR, _free_port, _wait_ready
+
+sys.path.insert(0, BACKEND_DIR)
+from utils.backends import ROUTING_PREFIX_CHARS, STICKY_LOAD_FACTOR, STICKY_SLACK  # noqa: E402
+
+BACKENDS = 3
+HEALTH_INTERVAL = 0.5
+# Requests held open at once while the spread across backends is sampled
+SPREAD_REQUESTS = 90
+
+
+class CheckFailed(AssertionError):
+    pass
+
+
+def _check(condition: bool, message: str):
+    if not condition:
+        raise CheckFailed(message)
+
+
+def _start_mock(port: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, os.path.join(TESTS_DIR, "mock_vllm.py"), "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def _start_gateway(workdir: str, mock_urls, gateway_port: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "VLLM_URLS": ",".join(mock_urls),
+        "BACKEND_HEALTH_INTERVAL": str(HEALTH_INTERVAL),
+        "API_TOKEN": "",
+        "METADATA_DB_PATH": os.path.join(workdir, "metadata.db"),
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR, "--port", str(gateway_port), "--log-level", "warning"],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=open(os.path.join(workdir, "gateway.log"), "w"),
+    )
+
+
+def _stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def _configure_mocks(session: aiohttp.ClientSession, mock_urls, **settings):
+    for url in mock_urls:
+        async with session.post(f"{url}/mock/config", json=settings) as resp:
+            resp.raise_for_status()
+
+
+async def _requests_served(session: aiohttp.ClientSession, mock_urls):
+    """Requests each mock has received so far, by URL."""
+    served = {}
+    for url in mock_urls:
+        async with session.get(f"{url}/mock/stats") as resp:
+            served[url] = (await resp.json())["requests_total"]
+    return served
+
+
+async def _backend_stats(session: aiohttp.ClientSession, gateway_url: str):
+    async with session.get(f"{gateway_url}/v1/stats") as resp:
+        return {b["url"]: b for b in (await resp.json())["backends"]}
+
+
+async def _chat(session: aiohttp.ClientSession, gateway_url: str, content: str) -> int:
+    payload = {"model": "mock", "messages": [{"role": "user", "content": content}], "max_tokens": 4}
+    async with session.post(f"{gateway_url}/v1/chat/completions", json=payload) as resp:
+        await resp.read()
+        return resp.status
+
+
+async def _wait_for(predicate, timeout: float, message: str):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await predicate():
+            return
+        await asyncio.sleep(0.1)
+    raise CheckFailed(message)
+
+
+async def check_spreading(session, gateway_url: str, mock_urls):
+    """
+    Requests held open upstream end up balanced within the bounded-load limit. They all share a
+    routing prefix, so hashing alone would send every one of them to the same backend.
+    """
+    await _configure_mocks(session, mock_urls, ttft=1.5, tokens_per_second=0)
+    prefix = "spread template ".ljust(ROUTING_PREFIX_CHARS, "x")
+    requests = [asyncio.create_task(_chat(session, gateway_url, f"{prefix} user {i}")) for i in range(SPREAD_REQUESTS)]
+    await asyncio.sleep(0.75)
+    outstanding = [b["outstanding"] for b in (await _backend_stats(session, gateway_url)).values()]
+    statuses = await asyncio.gather(*requests)
+
+    _check(all(status == 200 for status in statuses), f"spreading: failed requests {sorted(set(statuses))}")
+    _check(sum(outstanding) == SPREAD_REQUESTS, f"spreading: expected {SPREAD_REQUESTS} outstanding, saw {outstanding}")
+    # The bound is checked before a request is added, so a backend may end up one above it
+    _check(
+        max(outstanding) <= min(outstanding) * STICKY_LOAD_FACTOR + STICKY_SLACK + 1,
+        f"spreading: outstanding requests {outstanding} exceed the sticky load bound",
+    )
+    print(f"PASS least-outstanding spreading: {outstanding} outstanding per backend")
+
+
+async def check_sticky(session, gateway_url: str, mock_urls):
+    """Sequential prompts sharing their routing prefix all go to the same backend."""
+    await _configure_mocks(session, mock_urls, ttft=0.01, tokens_per_second=0)
+    prefix = "sticky template ".ljust(ROUTING_PREFIX_CHARS, "x")
+    for name in ("a", "b"):
+        before = await _requests_served(session, mock_urls)
+        for i in range(20):
+            _check(await _chat(session, gateway_url, f"{prefix}{name} user {i}") == 200, "sticky: request failed")
+        after = await _requests_served(session, mock_urls)
+        received = sorted(after[url] - before[url] for url in mock_urls)
+        _check(received == [0] * (len(mock_urls) - 1) + [20], f"sticky: prefix {name!r} was spread as {received}")
+    print("PASS sticky routing by prefix: each prefix stayed on one backend")
+
+
+async def check_ejection(session, gateway_url: str, mock_urls, mocks, victim: int):
+    """A killed backend is ejected without failing requests, then readmitted after a restart."""
+    await _configure_mocks(session, mock_urls, ttft=0.01, tokens_per_second=0)
+    url = mock_urls[victim]
+    _stop([mocks[victim]])
+
+    async def ejected():
+        return not (await _backend_stats(session, gateway_url))[url]["healthy"]
+
+    await _wait_for(ejected, 10 * HEALTH_INTERVAL + 5, f"ejection: {url} was not ejected after it stopped")
+    statuses = await asyncio.gather(*(_chat(session, gateway_url, f"ejected {i}") for i in range(60)))
+    _check(all(status == 200 for status in statuses), f"ejection: failed requests {sorted(set(statuses))}")
+    print(f"PASS ejection: {url} ejected and 60 requests served by the others")
+
+    port = int(url.rsplit(":", 1)[1])
+    mocks[victim] = _start_mock(port)
+    await _wait_ready(session, f"{url}/health")
+    await _configure_mocks(session, [url], ttft=0.01, tokens_per_second=0)
+
+    async def readmitted():
+        return (await _backend_stats(session, gateway_url))[url]["healthy"]
+
+    await _wait_for(readmitted, 10 * HEALTH_INTERVAL + 5, f"readmission: {url} was not readmitted after it restarted")
+    statuses = await asyncio.gather(*(_chat(session, gateway_url, f"readmitted {i}") for i in range(60)))
+    served = (await _requests_served(session, [url]))[url]
+    _check(all(status == 200 for status in statuses), f"readmission: failed requests {sorted(set(statuses))}")
+    _check(served > 0, f"readmission: {url} received no requests after it was readmitted")
+    print(f"PASS readmission: {url} readmitted and served {served} of 60 requests")
+
+
+async def run_checks():
+    mock_ports = [_free_port() for _ in range(BACKENDS)]
+    gateway_port = _free_port()
+    mock_urls = [f"http://127.0.0.1:{port}" for port in mock_ports]
+    gateway_url = f"http://127.0.0.1:{gateway_port}"
+
+    with tempfile.TemporaryDirectory(prefix="gateway-routing-") as workdir:
+        mocks = [_start_mock(port) for port in mock_ports]
+        gateway = _start_gateway(workdir, mock_urls, gateway_port)
+        try:
+            connector = aiohttp.TCPConnector(limit=0)
+            async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+                for url in mock_urls:
+                    await _wait_ready(session, f"{url}/health")
+                await _wait_ready(session, f"{gateway_url}/v1/stats")
+
+                await check_spreading(session, gateway_url, mock_urls)
+                await check_sticky(session, gateway_url, mock_urls)
+                await check_ejection(session, gateway_url, mock_urls, mocks, victim=1)
+        finally:
+            _stop([gateway, *mocks])
+
+
+def main():
+    try:
+        asyncio.run(run_checks())
+    except CheckFailed as e:
+        print(f"FAIL {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Gateway-overhead benchmark against the simulated vLLM server.
+
+Starts tests/mock_vllm.py and the gateway on free local ports, then measures
+  1. gateway-added latency: the same requests sent straight to the mock and through the gateway,
+  2. maximum sustainable req/s: closed-loop load against an instant mock at rising concurrency,
+  3. memory per in-flight request: gateway RSS growth while requests are held open upstream,
+and writes the results as JSON (stdout, or --output). Runs on any CPU machine.
+
+    python tests/gateway_benchmark.py --output gateway_benchmark.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(os.path.dirname(TESTS_DIR), "backend")
+
+CHAT_PAYLOAD = {
+    "model": "mock",
+    "messages": [{"role": "user", "content": "Hello, how are you?"}],
+    "max_tokens": 16,
+}
+# A throughput level counts as sustained while at most this fraction of requests fail
+MAX_ERROR_RATE = 0.01
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_bytes(pid: int):
+    """Resident set size of a process, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def _percentile(data, q: float):
+    """Linearly interpolated percentile of `data` (q in [0, 100])."""
+    if not data:
+        return None
+    ordered = sorted(data)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+async def _wait_ready(session: aiohttp.ClientSession, url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+
+async def _configure_mock(session: aiohttp.ClientSession, mock_url: str, **settings):
+    async with session.post(f"{mock_url}/mock/config", json=settings) as resp:
+        resp.raise_for_status()
+
+
+async def _timed_request(session: aiohttp.ClientSession, url: str, latencies: list, errors: list):
+    start = time.perf_counter()
+    try:
+        async with session.post(url, json=CHAT_PAYLOAD) as resp:
+            await resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+                return
+    except aiohttp.ClientError as e:
+        errors.append(repr(e))
+        return
+    latencies.append(time.perf_counter() - start)
+
+
+async def _closed_loop(session: aiohttp.ClientSession, url: str, concurrency: int, *, requests: int = None, duration: float = None):
+    """Runs `concurrency` workers back to back until `requests` are sent or `duration` passes."""
+    latencies, errors = [], []
+    sent = 0
+    deadline = time.monotonic() + duration if duration else None
+
+    async def worker():
+        nonlocal sent
+        while True:
+            if requests is not None and sent >= requests:
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            sent += 1
+            await _timed_request(session, url, latencies, errors)
+
+    start = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.monotonic() - start
+
+
+async def measure_overhead(session, mock_url: str, gateway_url: str, concurrency_levels, requests: int):
+    """Compares latency straight to the mock with latency through the gateway."""
+    await _configure_mock(session, mock_url, ttft=0.02, tokens_per_second=1000.0, max_concurrency=1024)
+    results = {}
+    for concurrency in concurrency_levels:
+        direct, _, _ = await _closed_loop(session, f"{mock_url}/v1/chat/completions", concurrency, requests=requests)
+        proxied, errors, _ = await _closed_loop(session, f"{gateway_url}/v1/chat/completions", concurrency, requests=requests)
+        level = {"requests": requests, "errors": len(errors)}
+        for q in (50, 90, 99):
+            direct_q, proxied_q = _percentile(direct, q), _percentile(proxied, q)
+            level[f"direct_p{q}_ms"] = _ms(direct_q)
+            level[f"gateway_p{q}_ms"] = _ms(proxied_q)
+            level[f"added_p{q}_ms"] = _ms(proxied_q - direct_q) if direct_q is not None and proxied_q is not None else None
+        level["added_mean_ms"] = _ms(statistics.mean(proxied) - statistics.mean(direct)) if direct and proxied else None
+        results[f"concurrency_{concurrency}"] = level
+    return results
+
+
+async def measure_throughput(session, mock_url: str, gateway_url: str, concurrency_levels, duration: float):
+    """Finds the highest req/s the gateway sustains when the backend answers instantly."""
+    await _configure_mock(session, mock_url, ttft=0.0, tokens_per_second=0.0, max_concurrency=100000)
+    levels = []
+    for concurrency in concurrency_levels:
+        latencies, errors, elapsed = await _closed_loop(session, f"{gateway_url}/v1/chat/completions", concurrency, duration=duration)
+        total = len(latencies) + len(errors)
+        levels.append({
+            "concurrency": concurrency,
+            "rps": round(len(latencies) / elapsed, 2),
+            "error_rate": round(len(errors) / total, 4) if total else None,
+            "p50_ms": _ms(_percentile(latencies, 50)),
+            "p99_ms": _ms(_percentile(latencies, 99)),
+        })
+    sustained = [level for level in levels if level["error_rate"] is not None and level["error_rate"] <= MAX_ERROR_RATE]
+    best = max(sustained, key=lambda level: level["rps"]) if sustained else None
+    return {
+        "max_sustainable_rps": best["rps"] if best else None,
+        "at_concurrency": best["concurrency"] if best else None,
+        "levels": levels,
+    }
+
+
+async def measure_memory(session, mock_url: str, gateway_url: str, gateway_pid: int, inflight: int):
+    """Holds `inflight` requests open upstream and reports the gateway's RSS growth per request."""
+    await _configure_mock(session, mock_url, ttft=3600.0, tokens_per_second=0.0, max_concurrency=100000)
+    await asyncio.sleep(0.5)
+    baseline = _rss_bytes(gateway_pid)
+
+    tasks = [asyncio.create_task(session.post(f"{gateway_url}/v1/chat/completions", json=CHAT_PAYLOAD)) for _ in range(inflight)]
+    # Wait until the gateway has accepted everything: requests are upstream or queued inside it
+    deadline = time.monotonic() + 60
+    upstream = 0
+    while time.monotonic() < deadline:
+        async with session.get(f"{mock_url}/mock/stats") as resp:
+            upstream = (await resp.json())["running"]
+        async with session.get(f"{gateway_url}/v1/stats") as resp:
+            queued = (await resp.json())["metrics"].get("gateway_queue_depth", {}).get("queue=interactive", 0)
+        if upstream + queued >= inflight:
+            break
+        await asyncio.sleep(0.2)
+    await asyncio.sleep(1.0)
+    loaded = _rss_bytes(gateway_pid)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await _configure_mock(session, mock_url, ttft=0.0)
+
+    per_request = (loaded - baseline) / inflight if baseline is not None and loaded is not None else None
+    return {
+        "inflight_requests": inflight,
+        "in_flight_upstream": upstream,
+        "baseline_rss_bytes": baseline,
+        "loaded_rss_bytes": loaded,
+        "bytes_per_inflight_request": round(per_request) if per_request is not None else None,
+    }
+
+
+def _start_processes(workdir: str, mock_port: int, gateway_port: int):
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(TESTS_DIR, "mock_vllm.py"), "--port", str(mock_port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    env = {
+        **os.environ,
+        "VLLM_URL": f"http://127.0.0.1:{mock_port}",
+        "API_TOKEN": "",
+        "METADATA_DB_PATH": os.path.join(workdir, "metadata.db"),
+        # Let the memory phase queue every request instead of shedding it
+        "INTERACTIVE_MAX_QUEUED": "1000000",
+        "INTERACTIVE_QUEUE_TIMEOUT": "3600",
+    }
+    gateway = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR, "--port", str(gateway_port), "--log-level", "warning"],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=open(os.path.join(workdir, "gateway.log"), "w"),
+    )
+    return mock, gateway
+
+
+async def run_benchmark(args) -> dict:
+    mock_port, gateway_port = _free_port(), _free_port()
+    mock_url, gateway_url = f"http://127.0.0.1:{mock_port}", f"http://127.0.0.1:{gateway_port}"
+
+    with tempfile.TemporaryDirectory(prefix="gateway-bench-") as workdir:
+        mock, gateway = _start_processes(workdir, mock_port, gateway_port)
+        try:
+            connector = aiohttp.TCPConnector(limit=0)
+            async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+                await _wait_ready(session, f"{mock_url}/health")
+                await _wait_ready(session, f"{gateway_url}/v1/stats")
+
+                results = {
+                    "benchmark": "gateway_overhead",
+                    "started_at": int(time.time()),
+                    "python": sys.version.split()[0],
+                    "overhead": await measure_overhead(session, mock_url, gateway_url, args.overhead_concurrency, args.overhead_requests),
+                    "throughput": await measure_throughput(session, mock_url, gateway_url, args.throughput_concurrency, args.throughput_duration),
+                    "memory": await measure_memory(session, mock_url, gateway_url, gateway.pid, args.memory_inflight),
+                }
+        finally:
+            for process in (gateway, mock):
+                process.terminate()
+            for process in (gateway, mock):
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure gateway overhead against the simulated vLLM server.")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout.")
+    parser.add_argument("--overhead-concurrency", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--overhead-requests", type=int, default=500)
+    parser.add_argument("--throughput-concurrency", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--throughput-duration", type=float, default=10.0)
+    parser.add_argument("--memory-inflight", type=int, default=1000)
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
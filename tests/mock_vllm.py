@@ -0,0 +1,213 @@
+"""
+Simulated vLLM server for measuring the gateway without a GPU.
+
+Speaks the parts of the OpenAI/vLLM API the gateway uses: /v1/chat/completions (JSON and SSE
+streaming), /health and a vLLM-style Prometheus /metrics. Latency is modelled as a fixed time to
+first token plus a decode rate, at most --max-concurrency requests run at once (the rest wait,
+like vLLM's scheduler queue), and prompts that do not fit --max-model-len get vLLM's 400 error.
+
+    python tests/mock_vllm.py --port 8000 --ttft 0.05 --tokens-per-second 50 --max-concurrency 256
+
+Settings can be changed at runtime with POST /mock/config, e.g. {"ttft": 0.5}.
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from aiohttp import web
+
+# Rough characters per token used to size prompts without a tokenizer
+CHARS_PER_TOKEN = 4
+
+
+class MockVLLM:
+    def __init__(self, ttft: float, tokens_per_second: float, max_concurrency: int, max_model_len: int, output_tokens: int):
+        self.config = {
+            "ttft": ttft,
+            "tokens_per_second": tokens_per_second,
+            "max_concurrency": max_concurrency,
+            "max_model_len": max_model_len,
+            "output_tokens": output_tokens,
+        }
+        self.running = 0
+        self.waiting = 0
+        self.requests_total = 0
+        self.prompt_tokens_total = 0
+        self.generation_tokens_total = 0
+        self._slots_free = asyncio.Condition()
+
+    def _token_delay(self) -> float:
+        rate = self.config["tokens_per_second"]
+        return 1.0 / rate if rate > 0 else 0.0
+
+    async def _acquire_slot(self):
+        self.waiting += 1
+        async with self._slots_free:
+            await self._slots_free.wait_for(lambda: self.running < self.config["max_concurrency"])
+            self.waiting -= 1
+            self.running += 1
+
+    async def _release_slot(self):
+        async with self._slots_free:
+            self.running -= 1
+            self._slots_free.notify()
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        messages = body.get("messages") or []
+        prompt_tokens = max(1, sum(len(str(m.get("content") or "")) for m in messages) // CHARS_PER_TOKEN)
+        max_tokens = body.get("max_tokens") or self.config["output_tokens"]
+        completion_tokens = min(max_tokens, self.config["output_tokens"])
+        max_model_len = self.config["max_model_len"]
+
+        if prompt_tokens + max_tokens > max_model_len:
+            return web.json_response(
+                {
+                    "object": "error",
+                    "message": (
+                        f"This model's maximum context length is {max_model_len} tokens. However, you requested "
+                        f"{prompt_tokens + max_tokens} tokens ({prompt_tokens} in the messages, {max_tokens} in the "
+                        "completion). Please reduce the length of the messages or completion."
+                    ),
+                    "type": "BadRequestError",
+                    "param": None,
+                    "code": 400,
+                },
+                status=400,
+            )
+
+        self.requests_total += 1
+        await self._acquire_slot()
+        try:
+            await asyncio.sleep(self.config["ttft"])
+            self.prompt_tokens_total += prompt_tokens
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            created = int(time.time())
+            model = body.get("model", "mock")
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+
+            if body.get("stream"):
+                return await self._stream(request, body, completion_id, created, model, completion_tokens, usage)
+
+            await asyncio.sleep(self._token_delay() * max(completion_tokens - 1, 0))
+            self.generation_tokens_total += completion_tokens
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(["tok"] * completion_tokens)},
+                    "finish_reason": "length" if completion_tokens == max_tokens else "stop",
+                }],
+                "usage": usage,
+            })
+        finally:
+            await self._release_slot()
+
+    async def _stream(self, request, body, completion_id, created, model, completion_tokens, usage) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        def event(delta, finish_reason=None, extra=None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            chunk.update(extra or {})
+            return f"data: {json.dumps(chunk)}\n\n".encode()
+
+        delay = self._token_delay()
+        await response.write(event({"role": "assistant", "content": ""}))
+        for i in range(completion_tokens):
+            if i and delay:
+                await asyncio.sleep(delay)
+            await response.write(event({"content": "tok "}))
+            self.generation_tokens_total += 1
+        await response.write(event({}, finish_reason="length"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await response.write(f"data: {json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.Response(text="")
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        kv_usage = min(1.0, self.running / max(1, self.config["max_concurrency"]))
+        lines = [
+            "# TYPE vllm:num_requests_running gauge",
+            f'vllm:num_requests_running{{model_name="mock"}} {self.running}',
+            "# TYPE vllm:num_requests_waiting gauge",
+            f'vllm:num_requests_waiting{{model_name="mock"}} {self.waiting}',
+            "# TYPE vllm:kv_cache_usage_perc gauge",
+            f'vllm:kv_cache_usage_perc{{model_name="mock"}} {kv_usage}',
+            "# TYPE vllm:num_preemptions_total counter",
+            'vllm:num_preemptions_total{model_name="mock"} 0',
+            "# TYPE vllm:prompt_tokens_total counter",
+            f'vllm:prompt_tokens_total{{model_name="mock"}} {self.prompt_tokens_total}',
+            "# TYPE vllm:generation_tokens_total counter",
+            f'vllm:generation_tokens_total{{model_name="mock"}} {self.generation_tokens_total}',
+            "# TYPE vllm:request_success_total counter",
+            f'vllm:request_success_total{{model_name="mock"}} {self.requests_total}',
+        ]
+        return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+    async def update_config(self, request: web.Request) -> web.Response:
+        changes = await request.json()
+        unknown = set(changes) - set(self.config)
+        if unknown:
+            return web.json_response({"error": f"Unknown settings: {sorted(unknown)}"}, status=400)
+        self.config.update(changes)
+        async with self._slots_free:
+            self._slots_free.notify_all()
+        return web.json_response(self.config)
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "running": self.running,
+            "waiting": self.waiting,
+            "requests_total": self.requests_total,
+            "config": self.config,
+        })
+
+
+def create_app(ttft: float = 0.05, tokens_per_second: float = 50.0, max_concurrency: int = 256, max_model_len: int = 8192, output_tokens: int = 64) -> web.Application:
+    mock = MockVLLM(ttft, tokens_per_second, max_concurrency, max_model_len, output_tokens)
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", mock.chat_completions)
+    app.router.add_get("/health", mock.health)
+    app.router.add_get("/metrics", mock.metrics)
+    app.router.add_post("/mock/config", mock.update_config)
+    app.router.add_get("/mock/stats", mock.stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated vLLM server for gateway benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--ttft", type=float, default=0.05, help="Seconds before the first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Decode rate per request; 0 for instant.")
+    parser.add_argument("--max-concurrency", type=int, default=256, help="Requests running at once; the rest wait.")
+    parser.add_argument("--max-model-len", type=int, default=8192, help="Context length; longer requests get a 400.")
+    parser.add_argument("--output-tokens", type=int, default=64, help="Upper bound on generated tokens per request.")
+    args = parser.parse_args()
+
+    app = create_app(args.ttft, args.tokens_per_second, args.max_concurrency, args.max_model_len, args.output_tokens)
+    web.run_app(app, host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
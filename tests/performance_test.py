@@ -1,5 +1,10 @@
+import argparse
 import asyncio
 import aiohttp
+import collections
+import math
+import random
+import sys
 import time
 import os
 import json
@@ -91,8 +96,12 @@ async def monitor_batch_status(session: aiohttp.ClientSession, batch_id: str):
                 break
         await asyncio.sleep(5)
 
-async def single_request_worker(session: aiohttp.ClientSession, stop_event: asyncio.Event, results: dict):
-    """A worker that continuously sends single chat completion requests."""
+async def single_request_worker(session: aiohttp.ClientSession, stop_event: asyncio.Event, results: dict, think_time: float = 0.1):
+    """
+    A closed-loop worker that continuously sends single chat completion requests, pausing
+    `think_time` seconds between them. Closed-loop load slows down with the server, so it
+    cannot show queueing collapse; use the `openloop` command for that.
+    """
     payload = {
         "model": "qwen3-4b",
         "messages": [{"role": "user", "content": "Hello, how are you?"}],
@@ -117,7 +126,15 @@ async def single_request_worker(session: aiohttp.ClientSession, stop_event: asyn
         except aiohttp.ClientError:
             results['errors'] += 1
         
-        await asyncio.sleep(0.1) # Small sleep to prevent overwhelming the server from a single worker
+        await asyncio.sleep(think_time)
+
+def percentile(data: list, q: float) -> float:
+    """Linearly interpolated percentile of `data`, with q in [0, 100]."""
+    ordered = sorted(data)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
 
 def print_stats(
     label: str,
@@ -155,11 +172,8 @@ def print_stats(
         print(f"     - Average: {statistics.mean(data):.4f}s")
         print(f"     - Median (p50): {statistics.median(data):.4f}s")
         if len(data) > 1:
-            data.sort()
-            p95_index = int(len(data) * 0.95)
-            p99_index = int(len(data) * 0.99)
-            print(f"     - p95: {data[p95_index]:.4f}s")
-            print(f"     - p99: {data[p99_index]:.4f}s")
+            print(f"     - p95: {percentile(data, 95):.4f}s")
+            print(f"     - p99: {percentile(data, 99):.4f}s")
         print(f"     - Min: {min(data):.4f}s")
         print(f"     - Max: {max(data):.4f}s")
 
@@ -266,7 +280,304 @@ async def run_batch_only_test():
         await monitor_batch_status(session, batch_id)
 
 
-async def main():
+# --- Open-loop load generation ---------------------------------------------------------------
+
+# Words used to build synthetic prompts; most are a single token for common tokenizers
+PROMPT_WORDS = (
+    "the of and to in is that for it as with was on be by this are from at or an have not "
+    "they which one you were all we her she there would their will when who him been has more"
+).split()
+# Quantiles reported for every latency metric
+REPORT_PERCENTILES = (50, 90, 95, 99)
+# Metrics compared by the `compare` command: (path in a rate result, True if higher is better)
+COMPARED_METRICS = (
+    (("ttft", "p50"), False),
+    (("ttft", "p99"), False),
+    (("latency", "p50"), False),
+    (("latency", "p99"), False),
+    (("tpot", "p99"), False),
+    (("achieved_rps",), True),
+    (("goodput_rps",), True),
+    (("error_rate",), False),
+)
+
+
+def parse_distribution(spec: str):
+    """
+    Parses a length distribution into a sampler taking a `random.Random`. Accepted forms:
+    `N` (fixed), `uniform:LOW:HIGH`, `normal:MEAN:STD`, `lognormal:MEDIAN:SIGMA`, `exponential:MEAN`.
+    Samples are rounded and at least 1.
+    """
+    kind, _, rest = spec.partition(":")
+    params = [float(p) for p in rest.split(":")] if rest else []
+    if not rest:
+        value = int(kind)
+        return lambda rng: value
+    if kind == "uniform" and len(params) == 2:
+        low, high = params
+        sample = lambda rng: rng.uniform(low, high)
+    elif kind == "normal" and len(params) == 2:
+        mean, std = params
+        sample = lambda rng: rng.gauss(mean, std)
+    elif kind == "lognormal" and len(params) == 2:
+        median, sigma = params
+        sample = lambda rng: rng.lognormvariate(math.log(median), sigma)
+    elif kind == "exponential" and len(params) == 1:
+        mean, = params
+        sample = lambda rng: rng.expovariate(1 / mean)
+    else:
+        raise ValueError(f"Invalid length distribution: {spec!r}")
+    return lambda rng: max(1, round(sample(rng)))
+
+
+def load_trace(path: str) -> list:
+    """
+    Reads a JSONL arrival trace. Each line needs `timestamp` (seconds, any origin) and may give
+    `prompt_tokens` and `output_tokens`; missing lengths are drawn from the configured distributions.
+    """
+    arrivals = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                arrivals.append((float(record["timestamp"]), record.get("prompt_tokens"), record.get("output_tokens")))
+    arrivals.sort(key=lambda a: a[0])
+    origin = arrivals[0][0] if arrivals else 0.0
+    return [(at - origin, prompt, output) for at, prompt, output in arrivals]
+
+
+def build_schedule(rate: float, duration: float, args, rng: random.Random) -> list:
+    """Returns the (offset seconds, prompt tokens, output tokens) of every request to send."""
+    if args.trace:
+        trace = load_trace(args.trace)
+        if len(trace) > 1 and trace[-1][0] > 0:
+            # Stretch or compress the trace so its average rate matches the target
+            scale = (len(trace) - 1) / trace[-1][0] / rate
+        else:
+            scale = 1.0
+        schedule = [(at * scale, prompt, output) for at, prompt, output in trace]
+        schedule = [entry for entry in schedule if entry[0] < duration]
+    else:
+        schedule, at = [], 0.0
+        while True:
+            at += rng.expovariate(rate)
+            if at >= duration:
+                break
+            schedule.append((at, None, None))
+    return [
+        (at, prompt or args.prompt_tokens(rng), output or args.output_tokens(rng))
+        for at, prompt, output in schedule
+    ]
+
+
+def build_prompt(tokens: int, rng: random.Random) -> str:
+    return " ".join(rng.choice(PROMPT_WORDS) for _ in range(tokens))
+
+
+async def timed_stream_request(session: aiohttp.ClientSession, args, prompt: str, max_tokens: int) -> dict:
+    """Sends one streaming chat completion and returns its timings and outcome."""
+    payload = {
+        "model": args.model,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    headers = {"Authorization": f"Bearer {args.api_key}"}
+    start = time.perf_counter()
+    result = {"status": None, "ttft": None, "latency": None, "completion_tokens": None}
+    try:
+        async with session.post(f"{args.url}/v1/chat/completions", json=payload, headers=headers) as resp:
+            result["status"] = resp.status
+            if resp.status != 200:
+                await resp.read()
+                return result
+            async for line in resp.content:
+                if not line.startswith(b"data: ") or line.startswith(b"data: [DONE]"):
+                    continue
+                if result["ttft"] is None:
+                    result["ttft"] = time.perf_counter() - start
+                chunk = json.loads(line[6:])
+                if chunk.get("usage"):
+                    result["completion_tokens"] = chunk["usage"].get("completion_tokens")
+        result["latency"] = time.perf_counter() - start
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        result["status"] = type(e).__name__
+    return result
+
+
+def summarize(data: list) -> dict:
+    if not data:
+        return None
+    summary = {"mean": round(statistics.mean(data), 6)}
+    for q in REPORT_PERCENTILES:
+        summary[f"p{q}"] = round(percentile(data, q), 6)
+    summary["max"] = round(max(data), 6)
+    return summary
+
+
+async def run_open_loop(rate: float, args) -> dict:
+    """
+    Sends requests on a fixed arrival schedule regardless of how fast the server answers, so
+    queueing delay shows up in the latencies instead of silently lowering the offered load.
+    """
+    rng = random.Random(f"{args.seed}:{rate}")
+    schedule = build_schedule(rate, args.duration, args, rng)
+    print(f"\n--- Open-loop run: {rate:g} req/s offered, {len(schedule)} requests over {args.duration:g}s ---")
+
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    lateness = []
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = []
+        start = time.perf_counter()
+        for at, prompt_tokens, output_tokens in schedule:
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # How far behind schedule the generator itself fell; large values invalidate the run
+            lateness.append(max(0.0, time.perf_counter() - start - at))
+            tasks.append(asyncio.create_task(timed_stream_request(session, args, build_prompt(prompt_tokens, rng), output_tokens)))
+        results = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r["latency"] is not None]
+    errors = collections.Counter(str(r["status"]) for r in results if r["latency"] is None)
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    latencies = [r["latency"] for r in ok]
+    tpots = [
+        (r["latency"] - r["ttft"]) / (r["completion_tokens"] - 1)
+        for r in ok
+        if r["ttft"] is not None and (r["completion_tokens"] or 0) > 1
+    ]
+    within_slo = [
+        r for r in ok
+        if (args.slo_ttft is None or (r["ttft"] is not None and r["ttft"] <= args.slo_ttft))
+        and (args.slo_latency is None or r["latency"] <= args.slo_latency)
+    ]
+
+    summary = {
+        "offered_rps": rate,
+        "requests": len(results),
+        "completed": len(ok),
+        "errors": dict(errors),
+        "error_rate": round(1 - len(ok) / len(results), 6) if results else 0.0,
+        "elapsed_seconds": round(elapsed, 3),
+        "achieved_rps": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        "goodput_rps": round(len(within_slo) / elapsed, 3) if elapsed else 0.0,
+        "ttft": summarize(ttfts),
+        "latency": summarize(latencies),
+        "tpot": summarize(tpots),
+        "generator_lateness_p99": round(percentile(lateness, 99), 6) if lateness else None,
+    }
+    summary["slo_violations"] = slo_violations(summary, args)
+    summary["slo_met"] = not summary["slo_violations"]
+
+    print(f"   - Completed: {len(ok)}/{len(results)} (errors: {dict(errors) or 0})")
+    print(f"   - Achieved: {summary['achieved_rps']:.2f} req/s, goodput: {summary['goodput_rps']:.2f} req/s")
+    for name in ("ttft", "latency"):
+        if summary[name]:
+            print(f"   - {name.upper()} p50={summary[name]['p50']:.4f}s p99={summary[name]['p99']:.4f}s")
+    print(f"   - SLO {'met' if summary['slo_met'] else 'broken: ' + '; '.join(summary['slo_violations'])}")
+    return summary
+
+
+def slo_violations(summary: dict, args) -> list:
+    violations = []
+    if args.slo_ttft is not None and (summary["ttft"] is None or summary["ttft"]["p99"] > args.slo_ttft):
+        violations.append(f"p99 TTFT {summary['ttft'] and summary['ttft']['p99']} > {args.slo_ttft}s")
+    if args.slo_latency is not None and (summary["latency"] is None or summary["latency"]["p99"] > args.slo_latency):
+        violations.append(f"p99 latency {summary['latency'] and summary['latency']['p99']} > {args.slo_latency}s")
+    if summary["error_rate"] > args.slo_error_rate:
+        violations.append(f"error rate {summary['error_rate']} > {args.slo_error_rate}")
+    return violations
+
+
+async def run_rate_sweep(args) -> dict:
+    """Runs each rate in turn and stops at the first one whose SLO breaks."""
+    runs = []
+    for rate in sorted(args.rates):
+        runs.append(await run_open_loop(rate, args))
+        if not runs[-1]["slo_met"] and not args.no_stop:
+            break
+    passing = [run["offered_rps"] for run in runs if run["slo_met"]]
+    return {
+        "mode": "open_loop",
+        "started_at": int(time.time()),
+        "config": {
+            "url": args.url,
+            "model": args.model,
+            "arrivals": f"trace:{args.trace}" if args.trace else "poisson",
+            "rates": sorted(args.rates),
+            "duration": args.duration,
+            "prompt_tokens": args.prompt_tokens_spec,
+            "output_tokens": args.output_tokens_spec,
+            "slo_ttft_p99": args.slo_ttft,
+            "slo_latency_p99": args.slo_latency,
+            "slo_error_rate": args.slo_error_rate,
+            "seed": args.seed,
+        },
+        "runs": runs,
+        "max_rate_meeting_slo": max(passing) if passing else None,
+    }
+
+
+def _metric(run: dict, path: tuple):
+    value = run
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare_results(baseline: dict, candidate: dict, threshold: float) -> list:
+    """Returns a description of every metric that got worse by more than `threshold` (relative)."""
+    regressions = []
+    base_max, cand_max = baseline.get("max_rate_meeting_slo"), candidate.get("max_rate_meeting_slo")
+    if base_max is not None and (cand_max is None or cand_max < base_max):
+        regressions.append(f"max rate meeting SLO dropped from {base_max} to {cand_max} req/s")
+
+    candidate_runs = {run["offered_rps"]: run for run in candidate.get("runs", [])}
+    for base_run in baseline.get("runs", []):
+        rate = base_run["offered_rps"]
+        cand_run = candidate_runs.get(rate)
+        if cand_run is None:
+            continue
+        for path, higher_is_better in COMPARED_METRICS:
+            old, new = _metric(base_run, path), _metric(cand_run, path)
+            if old is None or new is None:
+                continue
+            name = ".".join(path)
+            if old == 0:
+                worse = new < 0 if higher_is_better else new > 0
+                change = float("inf") if worse else 0.0
+            else:
+                change = (new - old) / abs(old)
+                worse = change < -threshold if higher_is_better else change > threshold
+            print(f"   {rate:>8g} req/s  {name:<16} {old:>12.4f} -> {new:>12.4f}  ({change:+.1%}){'  REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append(f"{name} at {rate:g} req/s: {old} -> {new} ({change:+.1%})")
+    return regressions
+
+
+def run_compare(args) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"Comparing {args.candidate} against {args.baseline} (threshold {args.threshold:.0%})")
+    regressions = compare_results(baseline, candidate, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s):")
+        for regression in regressions:
+            print(f"   - {regression}")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+async def run_suite():
     # Test 1: Batch-only
     await run_batch_only_test()
 
@@ -285,5 +596,57 @@ async def main():
     await run_mixed_workload_test(concurrency=10)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks for the batched inference gateway.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("suite", help="Batch-only, closed-loop single-user and mixed-workload tests (default).")
+
+    openloop = subparsers.add_parser("openloop", help="Open-loop rate sweep against an SLO.")
+    openloop.add_argument("--url", default=API_BASE_URL)
+    openloop.add_argument("--api-key", default=API_KEY)
+    openloop.add_argument("--model", default="qwen3-4b")
+    openloop.add_argument("--rates", type=float, nargs="+", required=True, help="Offered req/s, swept in increasing order.")
+    openloop.add_argument("--duration", type=float, default=60.0, help="Seconds of arrivals per rate.")
+    openloop.add_argument("--trace", help="JSONL arrival trace to replay, scaled to each rate, instead of Poisson arrivals.")
+    openloop.add_argument("--prompt-tokens", dest="prompt_tokens_spec", default="lognormal:256:0.8")
+    openloop.add_argument("--output-tokens", dest="output_tokens_spec", default="lognormal:128:0.6")
+    openloop.add_argument("--slo-ttft", type=float, help="p99 TTFT limit in seconds.")
+    openloop.add_argument("--slo-latency", type=float, help="p99 end-to-end latency limit in seconds.")
+    openloop.add_argument("--slo-error-rate", type=float, default=0.01)
+    openloop.add_argument("--no-stop", action="store_true", help="Keep sweeping after the SLO breaks.")
+    openloop.add_argument("--request-timeout", type=float, default=600.0)
+    openloop.add_argument("--seed", type=int, default=0)
+    openloop.add_argument("--output", help="Write the JSON results here as well as to stdout.")
+
+    compare = subparsers.add_parser("compare", help="Flag regressions between two openloop result files.")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.add_argument("--threshold", type=float, default=0.10, help="Relative change that counts as a regression.")
+
+    args = parser.parse_args()
+    if args.command == "openloop":
+        try:
+            args.prompt_tokens = parse_distribution(args.prompt_tokens_spec)
+            args.output_tokens = parse_distribution(args.output_tokens_spec)
+        except ValueError as e:
+            openloop.error(str(e))
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.command == "compare":
+        sys.exit(run_compare(args))
+    if args.command == "openloop":
+        results = asyncio.run(run_rate_sweep(args))
+        text = json.dumps(results, indent=2)
+        print(text)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        return
+    asyncio.run(run_suite())
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()